@@ -0,0 +1,79 @@
+# MinHash + LSH against exact pairwise Jaccard on synthetic jokes, a third of them retold with small changes.
+#   python benchmarks/dedup.py --size 1000 --size 4000 --size 20000
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "chilean_humor"))
+import dedup  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def retell(rng, text):
+    # the same joke from another year: a few words dropped or swapped
+    words = text.split()
+    for _ in range(max(1, len(words) // 10)):
+        i = rng.randrange(len(words))
+        if rng.random() < 0.5:
+            words[i] = rng.choice(synthetic.WORDS)
+        elif len(words) > 1:
+            del words[i]
+    return " ".join(words)
+
+
+def corpus(size, seed=0):
+    rng = random.Random(seed)
+    texts = []
+    while len(texts) < size:
+        text = synthetic.sentence(rng, 20, 50)
+        texts.append(text)
+        if rng.random() < 0.33 and len(texts) < size:
+            texts.append(retell(rng, text))
+    return texts
+
+
+def brute_force(texts, threshold):
+    shingles = [dedup.shingle_set(text) for text in texts]
+    return {
+        (i, j)
+        for i in range(len(shingles))
+        for j in range(i + 1, len(shingles))
+        if dedup.jaccard(shingles[i], shingles[j]) >= threshold
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark near-duplicate detection")
+    parser.add_argument("--size", type=int, action="append", help="jokes, default 1000 2000 4000 20000")
+    parser.add_argument("--threshold", type=float, default=dedup.THRESHOLD)
+    parser.add_argument("--brute-force-limit", type=int, default=4000, help="skip the quadratic baseline above this size")
+    args = parser.parse_args()
+
+    print(f"{'jokes':>7} {'signatures':>11} {'lsh':>8} {'brute':>9} {'pairs':>7} {'recall':>7} {'precision':>9}")
+    for size in args.size or [1000, 2000, 4000, 20000]:
+        texts = corpus(size)
+
+        start = time.perf_counter()
+        matrix, _, _ = dedup.signatures(texts)
+        signing = time.perf_counter() - start
+        start = time.perf_counter()
+        left, right, _ = dedup.similar_pairs(matrix, args.threshold)
+        lsh = time.perf_counter() - start
+        found = set(zip(left.tolist(), right.tolist()))
+
+        if size > args.brute_force_limit:
+            print(f"{size:>7} {signing:>10.2f}s {lsh:>7.3f}s {'-':>9} {len(found):>7}")
+            continue
+        start = time.perf_counter()
+        exact = brute_force(texts, args.threshold)
+        brute = time.perf_counter() - start
+        recall = len(found & exact) / len(exact) if exact else 1.0
+        precision = len(found & exact) / len(found) if found else 1.0
+        print(f"{size:>7} {signing:>10.2f}s {lsh:>7.3f}s {brute:>8.2f}s {len(found):>7} {recall:>7.3f} {precision:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# Compare FTS5 MATCH queries with the LIKE scans Datasette falls back to without an index.
+#   python src/chilean_humor/build_database.py && python benchmarks/fts_vs_like.py
+import argparse
+import sqlite3
+import statistics
+import time
+
+QUERIES = ["suegra", "curado", "loro", "profesor", "carabinero", "matrimonio"]
+
+CASES = {
+    "jokes": ("TEXT", "ID"),
+    "transcripts": ("TRANSCRIPT", "rowid"),
+}
+
+
+def timed(conn, sql, params, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000, len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default="humor.db")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    print(f"{'table':<12} {'query':<12} {'like ms':>9} {'fts ms':>9} {'like rows':>10} {'fts rows':>9}")
+    for table, (column, pk) in CASES.items():
+        for query in QUERIES:
+            like_ms, like_rows = timed(
+                conn, f"SELECT {pk} FROM {table} WHERE {column} LIKE ? LIMIT 101", (f"%{query}%",), args.repeat
+            )
+            fts_ms, fts_rows = timed(
+                conn,
+                f"SELECT {table}.{pk} FROM {table} JOIN {table}_fts ON {table}_fts.rowid = {table}.rowid "
+                f"WHERE {table}_fts MATCH ? ORDER BY {table}_fts.rank LIMIT 101",
+                (query,),
+                args.repeat,
+            )
+            print(f"{table:<12} {query:<12} {like_ms:9.2f} {fts_ms:9.2f} {like_rows:10d} {fts_rows:9d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Time every offline pipeline stage on a synthetic archive, with the embedding API replaced by a local fake.
+#   python benchmarks/stages.py --scale 1 --scale 10 --scale 100
+#   python benchmarks/stages.py --compare benchmarks/results/old.json benchmarks/results/new.json
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+
+QUERIES = ["suegra", "curado", "loro", "profesor", "carabinero", "matrimonio"]
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+class FakeEmbeddings:
+    # same shape as client.embeddings.create, random unit vectors
+    def __init__(self, dimensions: int, seed: int = 0):
+        self.dimensions = dimensions
+        self.rng = np.random.default_rng(seed)
+        self.embeddings = self
+
+    def create(self, input, model):
+        vectors = self.rng.standard_normal((len(input), self.dimensions), dtype=np.float32)
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=v.tolist()) for i, v in enumerate(vectors)])
+
+
+def read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def alignment_work(files):
+    # transcripts are indexed and jokes parsed up front, so the alignment stage times TranscriptIndex.align alone
+    from chilean_humor.align import TranscriptIndex
+    from chilean_humor.utils import timestamp_seconds
+    from chilean_humor.jokes_to_df import TIMESTAMP_PATTERN, transcript_path
+    from chilean_humor.utils import extract_number
+
+    work = []
+    for f in files:
+        index = TranscriptIndex.from_file(transcript_path(extract_number(os.path.basename(f))))
+        if index is None:
+            continue
+        for joke in read_jsonl(f):
+            if not re.match(TIMESTAMP_PATTERN, str(joke["start_timestamp"])):
+                continue
+            work.append((index, joke.get("transcript") or joke["corrected_transcript"], timestamp_seconds(joke["start_timestamp"])))
+    return work
+
+
+def median_ms(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+class Run:
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, name, items, func):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        self.stages[name] = {"seconds": round(seconds, 4), "items": items, "per_second": round(items / seconds, 1) if seconds else None}
+        print(f"  {name:<26} {seconds:>9.3f}s {items:>10} items")
+        return result
+
+    def latency(self, name, func, repeat):
+        self.stages[name] = {"median_ms": round(median_ms(func, repeat), 4), "repeat": repeat}
+        print(f"  {name:<26} {self.stages[name]['median_ms']:>9.3f}ms")
+
+
+def run_scale(scale, dimensions, vector_limit, repeat, seed=0):
+    from chilean_humor.build_database import build_database
+    from chilean_humor.embed import EmbedJokeChunks, JokeChunk
+    from chilean_humor.extract_jokes import read_segments
+    from chilean_humor.jokes_to_df import build_jokes_table, read_refined_jokes
+    from chilean_humor.packing import TokenBudget, pack_segments
+    from chilean_humor.search import BM25Index
+    from chilean_humor.segment import Segment, group_speech_segments
+    from chilean_humor.vector_store import VectorStore
+
+    run = Run()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        print(f"{scale}x in {root}")
+        synthetic.generate(root, scale, seed)
+        os.chdir(root)
+        try:
+            routines = pd.read_csv("data/routines.csv")
+            routine_ids = routines.loc[routines["VIDEO"].notnull(), "ID"].tolist()
+
+            rng = random.Random(seed)
+            raw = [
+                [Segment(start_time=p["start"], end_time=p["start"] + p["duration"], transcript=p["text"], language="es") for p in synthetic.raw_phrases(rng)]
+                for _ in routine_ids
+            ]
+            run.time("segmentation", sum(map(len, raw)), lambda: [group_speech_segments(phrases) for phrases in raw])
+
+            transcripts = [read_segments(routine_id) for routine_id in routine_ids]
+            budget = TokenBudget()
+            blocks = run.time("prompt_packing", sum(map(len, transcripts)), lambda: [pack_segments(segments, budget) for segments in transcripts])
+            run.stages["prompt_packing"]["calls"] = sum(map(len, blocks))
+
+            files = sorted(glob.glob("jokes_refined/*.jsonl"))
+            n_jokes = sum(len(read_jsonl(f)) for f in files)
+            work = alignment_work(files)
+            run.time("alignment", len(work), lambda: [index.align(text, seconds) for index, text, seconds in work])
+            run.time("read_refined_jokes", n_jokes, lambda: read_refined_jokes(files))
+
+            jokes = run.time("jokes_table", len(routine_ids), lambda: build_jokes_table(manifest_path=".cache/jokes_manifest.json", full=True))
+            run.time("jokes_table_incremental", len(routine_ids), lambda: build_jokes_table(manifest_path=".cache/jokes_manifest.json"))
+
+            run.time("sqlite_load", len(jokes), lambda: build_database("humor.db", full=True))
+            run.time("sqlite_load_incremental", len(jokes), lambda: build_database("humor.db"))
+
+            import sqlite3
+            conn = sqlite3.connect("humor.db")
+            run.latency("fts_query", lambda: [
+                conn.execute("SELECT rowid FROM jokes_fts WHERE jokes_fts MATCH ? LIMIT 100", (q,)).fetchall() for q in QUERIES
+            ], repeat)
+            conn.close()
+
+            index = run.time("bm25_build", len(jokes), lambda: BM25Index.from_jokes(jokes))
+            run.latency("bm25_query", lambda: [index.search(q, k=10) for q in QUERIES], repeat)
+
+            sample = jokes.head(vector_limit)
+            chunks = [JokeChunk(**joke) for joke in sample.to_dict(orient="records")]
+            embedder = EmbedJokeChunks(embedding_client=FakeEmbeddings(dimensions, seed))
+            embedded = run.time("embed_fake", len(chunks), lambda: embedder.embed_batch(chunks))
+            store = run.time("vector_store_build", len(embedded), lambda: VectorStore.build(embedded, "vector_store"))
+            query = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+            run.latency("vector_search", lambda: store.search(query, k=10), repeat)
+            run.latency("vector_search_int8", lambda: store.search(query, k=10, rescore=50), repeat)
+        finally:
+            os.chdir(cwd)
+    return run.stages
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print(f"{old.get('git')} -> {new.get('git')}")
+    for scale, stages in new["scales"].items():
+        for name, result in stages.items():
+            before = old["scales"].get(scale, {}).get(name)
+            if not before:
+                continue
+            key = "seconds" if "seconds" in result else "median_ms"
+            ratio = result[key] / before[key] if before[key] else float("nan")
+            print(f"{scale:>5}x {name:<26} {before[key]:>10.3f} {result[key]:>10.3f} {ratio:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the offline pipeline stages on synthetic data")
+    parser.add_argument("--scale", type=float, action="append", help="multiples of the current archive, default 1 10 100")
+    parser.add_argument("--dimensions", type=int, default=256, help="fake embedding size")
+    parser.add_argument("--vector-limit", type=int, default=100000, help="jokes embedded for the vector stages")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", default=None, help="defaults to benchmarks/results/<timestamp>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    scales = args.scale or [1, 10, 100]
+    report = {
+        "git": git_revision(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "dimensions": args.dimensions,
+        "scales": {f"{scale:g}": run_scale(scale, args.dimensions, args.vector_limit, args.repeat) for scale in scales},
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# Synthetic archive shaped like data/*.csv, transcripts/, jokes/ and jokes_refined/, at any multiple of the
+# current size (131 routines with video, ~233 grouped segments and ~49 raw / ~27 refined jokes per routine).
+#   python benchmarks/synthetic.py --scale 10 --output /tmp/humor-10x
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+
+ROUTINES = 202
+ROUTINES_WITH_VIDEO = 131
+SHOWS = 109
+COMEDIANS = 129
+PHRASES_PER_ROUTINE = 580
+JOKES_PER_ROUTINE = 49
+REFINED_PER_ROUTINE = 27
+
+WORDS = (
+    "que la el de y en un una se no me le lo con por para pero porque cuando entonces dice "
+    "señor señora suegra compadre huaso curado carabinero profesor doctor cura gringo argentino "
+    "peruano viejo vieja niño cabro cabra mina gallo perro loro gato caballo vaca chancho "
+    "casa campo micro liceo hospital iglesia cantina restorán playa cerro quinta vergara viña "
+    "llega sale va viene tiene quiere sabe mira pregunta contesta grita llora ríe toma come "
+    "matrimonio mujer marido guagua pololo polola hermano abuelo sueldo plata fiesta asado "
+    "fútbol colocolo selección presidente gobierno diputado teléfono televisión festival monstruo "
+    "oye fíjate imagínate sabís cachai po hueón ya bueno claro nada todo siempre nunca después"
+).split()
+EVENT = "Festival Internacional de la Canción de Viña del Mar"
+NATIONALITIES = ["Chile", "Argentina", "Perú", "Colombia", "México", "España"]
+
+
+def sentence(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def timestamp(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def joke_timestamp(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def raw_phrases(rng: random.Random, n: int = PHRASES_PER_ROUTINE):
+    # what YouTube returns before grouping: short captions a few seconds apart, with music markers
+    phrases, t = [], 0.0
+    for i in range(n):
+        duration = rng.uniform(1.5, 4.0)
+        text = "[Música]" if i % 97 == 0 else sentence(rng, 4, 10)
+        phrases.append({"start": t, "duration": duration, "text": text})
+        t += duration + (rng.uniform(0.2, 2.0) if rng.random() < 0.3 else 0.0)
+    return phrases
+
+
+def write_csv(path: str, rows):
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def generate(output: str, scale: float = 1, seed: int = 0):
+    rng = random.Random(seed)
+    for folder in ("data", "transcripts", "jokes", "jokes_refined"):
+        os.makedirs(os.path.join(output, folder), exist_ok=True)
+
+    n_shows = max(int(SHOWS * scale), 1)
+    n_routines = max(int(ROUTINES * scale), 1)
+    video_ratio = ROUTINES_WITH_VIDEO / ROUTINES
+
+    write_csv(os.path.join(output, "data", "shows.csv"), [
+        {"ID": i, "TITLE": f"{sentence(rng, 1, 1).title()} {sentence(rng, 1, 1).title()} {i}"} for i in range(1, n_shows + 1)
+    ])
+    write_csv(os.path.join(output, "data", "comedians.csv"), [
+        {
+            "ID": i,
+            "SHOWID": rng.randint(1, n_shows),
+            "NAME": f"Humorista {i}",
+            "NATIONALITY": rng.choice(NATIONALITIES),
+            "BIRTHDATE": f"{rng.randint(1920, 2000)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "GENDER": rng.choice(["male", "female"]),
+        }
+        for i in range(1, max(int(COMEDIANS * scale), 1) + 1)
+    ])
+
+    routines = []
+    for i in range(1, n_routines + 1):
+        year = 1960 + (i * 64) // n_routines
+        has_video = rng.random() < video_ratio
+        routines.append({
+            "ID": i,
+            "EVENT": EVENT,
+            "VERSION": str(year - 1959),
+            "YEAR": year,
+            "TV": "",
+            "DATE": f"{year}-02-{rng.randint(10, 28)}",
+            "SHOWID": rng.randint(1, n_shows),
+            # 11 character ids, unique per routine
+            "VIDEO": f"https://www.youtube.com/watch?v=v{i:010d}" if has_video else "",
+        })
+    write_csv(os.path.join(output, "data", "routines.csv"), routines)
+
+    for routine in routines:
+        if not routine["VIDEO"]:
+            continue
+        routine_id = routine["ID"]
+        with open(os.path.join(output, "transcripts", f"routine_{routine_id}_transcript.jsonl"), "w", encoding="utf-8") as file:
+            t = 0.0
+            for _ in range(rng.randint(PHRASES_PER_ROUTINE // 3, PHRASES_PER_ROUTINE // 2)):
+                duration = rng.uniform(5, 25)
+                text = sentence(rng, 12, 30)
+                file.write(json.dumps({
+                    "start_time": round(t), "end_time": t + duration, "transcript": text, "transcript_length": len(text),
+                    "timestamp": timestamp(t), "from_whisper": False, "language": "es",
+                }, ensure_ascii=False) + "\n")
+                t += duration + rng.uniform(0.2, 2.0)
+
+        for folder, name, n in (("jokes", "repertoire", JOKES_PER_ROUTINE), ("jokes_refined", "refined_repertoire", REFINED_PER_ROUTINE)):
+            with open(os.path.join(output, folder, f"routine_{routine_id}_{name}.jsonl"), "w", encoding="utf-8") as file:
+                for j in range(rng.randint(n // 2, n * 3 // 2)):
+                    text = sentence(rng, 20, 50)
+                    file.write(json.dumps({
+                        "transcript": text, "corrected_transcript": text.capitalize() + ".", "start_timestamp": joke_timestamp(j * 20),
+                    }, ensure_ascii=False) + "\n")
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic archive at a multiple of the current size")
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(f"Generated {generate(args.output, args.scale, args.seed)}")
+
+
+if __name__ == "__main__":
+    main()
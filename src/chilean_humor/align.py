@@ -0,0 +1,98 @@
+import json
+import os
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from typing import List, Optional
+
+from chilean_humor.search import TOKEN_PATTERN, fold_accents, tokenize
+
+# the LLM's timestamp is usually within a minute of the joke, rarely after it
+WINDOW_BEFORE = 60
+WINDOW_AFTER = 120
+# a segment joins the match when more than half of its words are in the joke
+MIN_SHARE = 0.5
+# consecutive joke words that mark where it starts or ends inside a segment
+EDGE_RUN = 3
+
+
+@dataclass
+class Alignment:
+    start_time: Optional[float]
+    end_time: Optional[float]
+    confidence: float
+
+
+NO_ALIGNMENT = Alignment(None, None, 0.0)
+
+
+def _edge(tokens: List[str], joke: set, first: bool) -> float:
+    # fraction of the segment before the joke starts (or up to where it ends), words are assumed evenly spaced
+    run = min(EDGE_RUN, len(joke))
+    streak = 0
+    indices = range(len(tokens)) if first else range(len(tokens) - 1, -1, -1)
+    for i in indices:
+        streak = streak + 1 if tokens[i] in joke else 0
+        if streak >= run:
+            return (i - run + 1) / len(tokens) if first else (i + run) / len(tokens)
+    return 0.0 if first else 1.0
+
+
+class TranscriptIndex:
+    # segments sorted by start, bisect finds the ones near a timestamp without scanning the routine
+    def __init__(self, segments: List[dict]):
+        segments = sorted(segments, key=lambda segment: segment["start_time"])
+        self.starts = [float(segment["start_time"]) for segment in segments]
+        self.ends = [float(segment["end_time"]) for segment in segments]
+        # running maximum, so ends can be bisected even when segments overlap
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+        # accents are folded once for the whole routine, it costs more than the alignment itself
+        folded = fold_accents("\n".join(" ".join(segment["transcript"].split()) for segment in segments)).split("\n")
+        self.tokens = [TOKEN_PATTERN.findall(text) for text in folded] if segments else []
+        self.token_sets = [set(tokens) for tokens in self.tokens]
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_file(cls, path: str) -> Optional["TranscriptIndex"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as file:
+            return cls([json.loads(line) for line in file])
+
+    def window(self, seconds: float, before: float = WINDOW_BEFORE, after: float = WINDOW_AFTER) -> range:
+        return range(bisect_left(self.max_ends, seconds - before), bisect_right(self.starts, seconds + after))
+
+    def align(self, text: str, seconds: float, before: float = WINDOW_BEFORE, after: float = WINDOW_AFTER) -> Alignment:
+        joke = set(tokenize(text))
+        window = self.window(seconds, before, after)
+        if not joke or not window:
+            return NO_ALIGNMENT
+
+        # best run of consecutive segments: each word of the joke counts for it, each other word against it
+        best, best_range = 0.0, None
+        gain, run_start = 0.0, window.start
+        for i in window:
+            shared = len(self.token_sets[i] & joke)
+            score = shared - MIN_SHARE * len(self.token_sets[i])
+            if gain <= 0:
+                gain, run_start = score, i
+            else:
+                gain += score
+            # ties go to the segment closest to the claimed timestamp
+            if gain > best or (gain == best and best_range and abs(self.starts[run_start] - seconds) < abs(self.starts[best_range[0]] - seconds)):
+                best, best_range = gain, (run_start, i)
+        if best_range is None:
+            return NO_ALIGNMENT
+
+        first, last = best_range
+        matched = set().union(*self.token_sets[first:last + 1])
+        shared = len(matched & joke)
+        precision, recall = shared / len(matched), shared / len(joke)
+        confidence = 2 * precision * recall / (precision + recall) if shared else 0.0
+
+        start = self.starts[first] + _edge(self.tokens[first], joke, True) * (self.ends[first] - self.starts[first])
+        end = self.starts[last] + _edge(self.tokens[last], joke, False) * (self.ends[last] - self.starts[last])
+        return Alignment(round(start, 2), round(max(end, start), 2), round(confidence, 3))
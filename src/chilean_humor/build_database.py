@@ -1,7 +1,13 @@
 import sqlite_utils
 import pandas as pd
+import argparse
+import hashlib
 import json
+import os
 import re
+import time
+
+# CI runs this file directly without the package installed, the helpers it shares with chilean_humor.utils are repeated here
 
 def extract_video_id(url: str) -> str:
     match = re.search(
@@ -17,48 +23,203 @@ def convert_to_seconds(time_str):
     h, m, s = map(int, time_str.split(':'))
     return h * 3600 + m * 60 + s
 
-# Create a connection to the database
-db = sqlite_utils.Database("humor.db")
-
-# Insert data from CSV files into the database
-routines_df = pd.read_csv("data/routines.csv")
-comedians_df = pd.read_csv("data/comedians.csv")
-shows_df = pd.read_csv("data/shows.csv")
-jokes_df = pd.read_csv("data/jokes.csv")
-
-# Youtube transcripts
-
-# read all .jsonl files in the transcripts folder
-transcripts = []
-for routine_id, url in zip(routines_df["ID"], routines_df["VIDEO"]):
-    try:
-        with open(f"transcripts/routine_{routine_id}_transcript.jsonl", "r", encoding="utf-8") as file:
-            for line in file:
-                transcript = json.loads(line)
-                transcript["ID"] = routine_id
-                video_id = extract_video_id(url)
-                transcripts.append({"ID": routine_id, "TRANSCRIPT": transcript["transcript"], "TIMESTAMP": transcript["timestamp"], "URL": f"https://www.youtube.com/watch?v={video_id}&start={transcript["start_time"]}"})
-    except FileNotFoundError:
-        continue
-
-transcripts_df = pd.DataFrame(transcripts)
-
-jokes_df["START_TIME"] = jokes_df["start_timestamp"].apply(convert_to_seconds)
-jokes_df["URL"] = jokes_df.apply(lambda row: f"https://www.youtube.com/watch?v={row['video_id']}&start={row['START_TIME']}", axis=1)
-jokes_df["ID"] = range(1, len(jokes_df) + 1)
-jokes_df = jokes_df[["ID", "routine_id", "show_id", "event_name", "start_timestamp", "text", "URL"]]
-jokes_df.columns = ["ID", "ROUTINEID", "SHOWID", "EVENTNAME", "TIMESTAMP", "TEXT", "URL"]
-
-
-db["routines"].insert_all(routines_df.to_dict(orient="records"), alter=True, pk="ID")
-db["comedians"].insert_all(comedians_df.to_dict(orient="records"), alter=True, pk="ID")
-db["shows"].insert_all(shows_df.to_dict(orient="records"), alter=True, pk="ID")
-db["transcripts"].insert_all(transcripts_df.to_dict(orient="records"), alter=True, pk=("ID", "TIMESTAMP"))
-db["jokes"].insert_all(jokes_df.to_dict(orient="records"), alter=True, pk=("ID"))
-
-# Add foreign keys
-db["comedians"].add_foreign_key("SHOWID", "shows", "ID")
-db["routines"].add_foreign_key("SHOWID", "shows", "ID")
-db["transcripts"].add_foreign_key("ID", "routines", "ID")
-db["jokes"].add_foreign_key("ROUTINEID", "routines", "ID")
-db["jokes"].add_foreign_key("SHOWID", "shows", "ID")
\ No newline at end of file
+def file_hash(path):
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def rows_hash(rows):
+    return hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# Small tables are replaced as a whole when their CSV changes
+TABLES = {
+    "shows": ("data/shows.csv", []),
+    "routines": ("data/routines.csv", [("SHOWID", "shows", "ID")]),
+    "comedians": ("data/comedians.csv", [("SHOWID", "shows", "ID")]),
+}
+
+INDEXES = {
+    "comedians": [["SHOWID"]],
+    "routines": [["SHOWID"]],
+    "jokes": [["ROUTINEID"], ["SHOWID"]],
+}
+
+# Full-text search, accents folded so "cómo" matches "como". Prefix index for 2 and 3 letter prefixes
+FTS = {
+    "jokes": ["TEXT"],
+    "transcripts": ["TRANSCRIPT"],
+}
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+FTS_PREFIX = "2 3"
+
+def enable_fts(db, table, columns, tokenize=FTS_TOKENIZER, prefix=FTS_PREFIX):
+    # same layout as sqlite-utils enable_fts (so Datasette detects it), plus the prefix option
+    columns_sql = ", ".join(f'"{c}"' for c in columns)
+    old_values = ", ".join(f'old."{c}"' for c in columns)
+    new_values = ", ".join(f'new."{c}"' for c in columns)
+    prefix_sql = f"prefix='{prefix}', " if prefix else ""
+    db.executescript(f"""
+        CREATE VIRTUAL TABLE "{table}_fts" USING FTS5 ({columns_sql}, tokenize='{tokenize}', {prefix_sql}content="{table}");
+        INSERT INTO "{table}_fts" (rowid, {columns_sql}) SELECT rowid, {columns_sql} FROM "{table}";
+        CREATE TRIGGER "{table}_ai" AFTER INSERT ON "{table}" BEGIN
+          INSERT INTO "{table}_fts" (rowid, {columns_sql}) VALUES (new.rowid, {new_values});
+        END;
+        CREATE TRIGGER "{table}_ad" AFTER DELETE ON "{table}" BEGIN
+          INSERT INTO "{table}_fts" ("{table}_fts", rowid, {columns_sql}) VALUES('delete', old.rowid, {old_values});
+        END;
+        CREATE TRIGGER "{table}_au" AFTER UPDATE ON "{table}" BEGIN
+          INSERT INTO "{table}_fts" ("{table}_fts", rowid, {columns_sql}) VALUES('delete', old.rowid, {old_values});
+          INSERT INTO "{table}_fts" (rowid, {columns_sql}) VALUES (new.rowid, {new_values});
+        END;
+    """)
+
+def read_manifest(db):
+    if "_manifest" not in db.table_names():
+        return {}
+    return {row["SOURCE"]: row["HASH"] for row in db["_manifest"].rows}
+
+def read_transcripts(routine_id, video_id):
+    # video id is resolved once per routine, not once per line
+    transcripts = []
+    with open(f"transcripts/routine_{routine_id}_transcript.jsonl", "r", encoding="utf-8") as file:
+        for line in file:
+            transcript = json.loads(line)
+            transcripts.append({"ID": routine_id, "TRANSCRIPT": transcript["transcript"], "TIMESTAMP": transcript["timestamp"], "URL": f"https://www.youtube.com/watch?v={video_id}&start={transcript['start_time']}"})
+    return transcripts
+
+# same as ALIGNMENT_MIN_CONFIDENCE in config.py, this script does not import the package
+ALIGNMENT_MIN_CONFIDENCE = 0.5
+
+# joke IDs are ROUTINEID * JOKE_ID_STRIDE + position in the routine, so a routine's IDs do not depend on the others
+JOKE_ID_STRIDE = 10000
+
+def joke_ids(jokes_df):
+    # also stored with every embedding, topics joins on it instead of matching texts that can repeat within a routine
+    positions = jokes_df.groupby("routine_id", sort=False).cumcount() + 1
+    if len(positions) and positions.max() >= JOKE_ID_STRIDE:
+        raise ValueError(f"A routine has more than {JOKE_ID_STRIDE - 1} jokes, raise JOKE_ID_STRIDE")
+    return jokes_df["routine_id"].astype(int) * JOKE_ID_STRIDE + positions
+
+def jokes_table(jokes_df):
+    jokes_df = jokes_df.copy()
+    jokes_df["START_TIME"] = jokes_df["start_timestamp"].map(convert_to_seconds)
+    columns = ["ID", "routine_id", "show_id", "event_name", "start_timestamp", "text", "URL"]
+    names = ["ID", "ROUTINEID", "SHOWID", "EVENTNAME", "TIMESTAMP", "TEXT", "URL"]
+    if "aligned_start" in jokes_df:
+        # links start where the joke starts in the transcript, not where the LLM said it did
+        aligned = jokes_df["alignment_confidence"].fillna(0) >= ALIGNMENT_MIN_CONFIDENCE
+        jokes_df["START_TIME"] = jokes_df["START_TIME"].where(~aligned, jokes_df["aligned_start"].fillna(0).astype(int))
+        columns += ["aligned_start", "aligned_end", "alignment_confidence"]
+        names += ["ALIGNEDSTART", "ALIGNEDEND", "ALIGNMENTCONFIDENCE"]
+    jokes_df["URL"] = "https://www.youtube.com/watch?v=" + jokes_df["video_id"] + "&start=" + jokes_df["START_TIME"].astype(str)
+    jokes_df["ID"] = joke_ids(jokes_df)
+    jokes_df = jokes_df[columns]
+    jokes_df.columns = names
+    return jokes_df
+
+def build_database(db_path="humor.db", full=False):
+    start = time.perf_counter()
+    # a change to this script invalidates everything built by the previous version
+    builder_hash = file_hash(__file__)
+    if os.path.exists(db_path) and (full or read_manifest(sqlite_utils.Database(db_path)).get("build_database") != builder_hash):
+        os.remove(db_path)
+    db = sqlite_utils.Database(db_path)
+    manifest = read_manifest(db)
+    updated = {"build_database": builder_hash}
+    changed = []
+
+    for table, (path, foreign_keys) in TABLES.items():
+        source_hash = file_hash(path)
+        if manifest.get(path) != source_hash or table not in db.table_names():
+            df = pd.read_csv(path)
+            with db.conn:
+                if table in db.table_names():
+                    db[table].delete_where()
+                db[table].insert_all(df.to_dict(orient="records"), alter=True, pk="ID", foreign_keys=foreign_keys)
+            changed.append(table)
+        updated[path] = source_hash
+
+    routines_df = pd.read_csv("data/routines.csv")
+    routines_df = routines_df[routines_df["VIDEO"].notnull()]
+
+    # Youtube transcripts, one manifest entry per routine
+    routines_with_transcript = set()
+    for routine_id, url in zip(routines_df["ID"], routines_df["VIDEO"]):
+        path = f"transcripts/routine_{routine_id}_transcript.jsonl"
+        if not os.path.exists(path):
+            continue
+        routines_with_transcript.add(path)
+        source_hash = file_hash(path) + url
+        if manifest.get(path) != source_hash or "transcripts" not in db.table_names():
+            rows = read_transcripts(routine_id, extract_video_id(url))
+            with db.conn:
+                if "transcripts" in db.table_names():
+                    db["transcripts"].delete_where("ID = ?", [int(routine_id)])
+                db["transcripts"].insert_all(rows, alter=True, pk=("ID", "TIMESTAMP"), replace=True, foreign_keys=[("ID", "routines", "ID")])
+            changed.append(path)
+        updated[path] = source_hash
+
+    for path in manifest:
+        if path.startswith("transcripts/") and path not in routines_with_transcript:
+            db["transcripts"].delete_where("ID = ?", [int(re.search(r"\d+", path).group())])
+            changed.append(path)
+
+    # Jokes, one manifest entry per routine. Adding a joke to one routine only rewrites that routine
+    jokes_df = jokes_table(pd.read_csv("data/jokes.csv"))
+    routine_ids = set()
+    for routine_id, rows in jokes_df.groupby("ROUTINEID", sort=False):
+        key = f"jokes/{routine_id}"
+        routine_ids.add(key)
+        records = rows.to_dict(orient="records")
+        source_hash = rows_hash(records)
+        if manifest.get(key) != source_hash or "jokes" not in db.table_names():
+            with db.conn:
+                if "jokes" in db.table_names():
+                    db["jokes"].delete_where("ROUTINEID = ?", [int(routine_id)])
+                db["jokes"].insert_all(records, alter=True, pk="ID", replace=True, foreign_keys=[("ROUTINEID", "routines", "ID"), ("SHOWID", "shows", "ID")])
+            changed.append(key)
+        updated[key] = source_hash
+
+    for key in manifest:
+        if key.startswith("jokes/") and key not in routine_ids:
+            db["jokes"].delete_where("ROUTINEID = ?", [int(key.split("/")[1])])
+            changed.append(key)
+
+    # Indexes on the foreign key columns
+    for table, indexes in INDEXES.items():
+        if table in db.table_names():
+            for columns in indexes:
+                db[table].create_index(columns, if_not_exists=True)
+
+    # FTS tables are filled once after the first load, triggers keep them in sync afterwards.
+    # recursive_triggers (on by default in sqlite-utils) makes INSERT OR REPLACE fire the delete trigger
+    for table, columns in FTS.items():
+        if table not in db.table_names():
+            continue
+        if f"{table}_fts" not in db.table_names():
+            enable_fts(db, table, columns)
+        elif changed:
+            db.execute(f"INSERT INTO \"{table}_fts\" (\"{table}_fts\") VALUES ('optimize')")
+
+    with db.conn:
+        if "_manifest" in db.table_names():
+            db["_manifest"].delete_where()
+        db["_manifest"].insert_all([{"SOURCE": source, "HASH": h} for source, h in updated.items()], pk="SOURCE")
+
+    print(f"Updated {len(changed)} sources in {db_path} in {time.perf_counter() - start:.2f}s")
+    return len(changed) > 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Build humor.db from data/ and transcripts/")
+    parser.add_argument("--db", default="humor.db")
+    parser.add_argument("--full", action="store_true", help="delete the database and rebuild it from scratch")
+    args = parser.parse_args()
+
+    changed = build_database(args.db, full=args.full)
+
+    # lets the deploy workflow skip publishing when nothing changed
+    if "GITHUB_OUTPUT" in os.environ:
+        with open(os.environ["GITHUB_OUTPUT"], "a") as file:
+            file.write(f"changed={'true' if changed else 'false'}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+from pydantic import BaseModel
+from pydantic_core import to_jsonable_python
+
+from chilean_humor.config import CONFIG
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str = CONFIG["embedding_cache_path"]):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, text_hash TEXT NOT NULL, embedding BLOB NOT NULL, PRIMARY KEY (model, text_hash))"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, hashes: Iterable[str]) -> Dict[str, List[float]]:
+        # hits and misses are counted here only, once per requested text, storing never touches them
+        requested = list(hashes)
+        hashes = list(dict.fromkeys(requested))
+        found = {}
+        # stay below SQLite's default limit of bound parameters
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(
+                f"SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                [model, *batch],
+            )
+            for h, blob in rows:
+                found[h] = array("f", blob).tolist()
+        hits = sum(1 for h in requested if h in found)
+        self.hits += hits
+        self.misses += len(requested) - hits
+        return found
+
+    def put_many(self, model: str, items: Iterable[Tuple[str, List[float]]]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, embedding) VALUES (?, ?, ?)",
+                [(model, h, array("f", embedding).tobytes()) for h, embedding in items],
+            )
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.conn.close()
+
+
+class LLMCache:
+    def __init__(
+        self,
+        path: str = CONFIG["llm_cache_path"],
+        max_bytes: int = CONFIG["llm_cache_max_bytes"],
+        read_only: bool = False,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if read_only:
+            # CI uses a committed or restored cache and must never write to it
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False) if os.path.exists(path) else None
+            return
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(model: str, messages: List[dict], response_model: Type[BaseModel], params: Optional[dict] = None) -> str:
+        payload = {
+            "model": model,
+            "messages": messages,
+            "schema": response_model.model_json_schema(),
+            "params": params or {},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, response_model: Type[BaseModel]) -> Optional[BaseModel]:
+        return self.get_any([key], response_model)
+
+    def get_any(self, keys: List[str], response_model: Type[BaseModel]) -> Optional[BaseModel]:
+        # first of several equivalent keys (one per fallback model), a single lookup for hits and misses
+        row = None
+        if self.conn is not None:
+            with self._lock:
+                for key in keys:
+                    row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        if not self.read_only:
+                            with self.conn:
+                                self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                        break
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return response_model.model_validate(json.loads(zlib.decompress(row[0])))
+
+    def put(self, key: str, response: BaseModel):
+        if self.read_only:
+            return
+        # dict(response) keeps fields marked exclude=True, they are needed to validate on the way back
+        value = zlib.compress(json.dumps(to_jsonable_python(dict(response)), ensure_ascii=False).encode("utf-8"))
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # least recently used first
+        freed = 0
+        stale = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total - freed <= self.max_bytes:
+                break
+            stale.append((key,))
+            freed += size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_llm_cache = None
+
+
+def get_llm_cache() -> LLMCache:
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMCache(read_only=os.environ.get("LLM_CACHE_READONLY", "") not in ("", "0", "false"))
+    return _llm_cache
@@ -0,0 +1,128 @@
+import argparse
+
+# stage modules pull in numpy, pandas and pydantic, only the module of the chosen command is imported
+
+
+def run(args):
+    from chilean_humor.gate import ContinuityGate
+    from chilean_humor.instrument import metrics, write_prometheus, write_report
+    from chilean_humor.packing import TokenBudget
+    from chilean_humor.pipeline import Pipeline, print_plan
+
+    budget = TokenBudget(args.model, overlap=args.overlap)
+    gate = None if args.no_gate else ContinuityGate()
+    pipeline = Pipeline(
+        manifest_path=args.manifest,
+        budget=budget,
+        gate=gate,
+        recheck_chains=args.recheck_chains,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        stages=args.stages,
+        force=args.force,
+        profile_dir=args.profile,
+        profiler=args.profiler,
+    )
+    if args.dry_run:
+        print_plan(pipeline.plan(args.only))
+        return
+    try:
+        pipeline.run(args.only)
+    finally:
+        # written even when the run stops halfway, that is when it is most needed
+        if args.report:
+            write_report(args.report)
+        if args.metrics:
+            write_prometheus(args.metrics)
+        report = metrics.report()
+        print(f"Run took {report['seconds']:.1f}s, estimated cost ${report['cost_usd']:.2f}")
+
+
+# local commands, none of them needs an API key
+
+
+def jokes_table(args):
+    from chilean_humor.jokes_to_df import build_jokes_table
+    build_jokes_table(full=args.full)
+
+
+def database(args):
+    from chilean_humor.build_database import build_database
+    build_database(args.db, full=args.full)
+
+
+def clusters(args):
+    from chilean_humor.dedup import build_clusters
+    build_clusters(args.db)
+
+
+def topics(args):
+    from chilean_humor.topics import update_topics
+    update_topics(args.db, refit=args.refit)
+
+
+def search(args):
+    from chilean_humor.search import BM25Index
+    index = BM25Index.load(args.index)
+    for result in index.search(args.query, k=args.k):
+        print(f"{result['score']:6.2f}  {result['year']}  routine {result['routine_id']}: {result['text']}")
+
+
+def main():
+    from chilean_humor.config import CONFIG, GLOBAL_STAGES, ROUTINE_STAGES
+
+    parser = argparse.ArgumentParser(prog="chilean-humor", description="Tracking the history of Chilean humor")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="bring every routine up to date, rerunning only stale stages")
+    run_parser.add_argument("--only", type=int, action="append", metavar="ROUTINE_ID", help="limit the run to this routine, can be repeated")
+    run_parser.add_argument("--dry-run", action="store_true", help="print the plan without running anything")
+    run_parser.add_argument("--workers", type=int, default=4, help="routines processed at the same time")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="LLM requests in flight across all routines")
+    run_parser.add_argument("--rpm", type=float, default=None, help="requests per minute")
+    run_parser.add_argument("--tpm", type=float, default=None, help="tokens per minute")
+    run_parser.add_argument("--stages", nargs="+", choices=ROUTINE_STAGES + GLOBAL_STAGES, help="stages allowed to run, vector_index is off by default")
+    run_parser.add_argument("--force", nargs="+", choices=ROUTINE_STAGES + GLOBAL_STAGES, default=[], help="rerun these stages even when fresh")
+    run_parser.add_argument("--model", default=CONFIG["chat_model"])
+    run_parser.add_argument("--overlap", type=int, default=2, help="segments repeated at extraction block boundaries")
+    run_parser.add_argument("--no-gate", action="store_true", help="send every refine pair to the LLM")
+    run_parser.add_argument("--recheck-chains", action="store_true")
+    run_parser.add_argument("--manifest", default=CONFIG["pipeline_manifest_path"])
+    run_parser.add_argument("--report", metavar="PATH", help="write time, retries, tokens and cost per stage and routine as JSON")
+    run_parser.add_argument("--metrics", metavar="PATH", help="write the same metrics in Prometheus text format")
+    run_parser.add_argument("--profile", metavar="DIR", help="profile the local stages (jokes_table, database, clusters, vector_index, topics) into DIR")
+    run_parser.add_argument("--profiler", choices=["cprofile", "pyinstrument"], default="cprofile")
+    run_parser.set_defaults(func=run)
+
+    jokes_parser = commands.add_parser("jokes-table", help="rebuild data/jokes.csv from jokes_refined/")
+    jokes_parser.add_argument("--full", action="store_true", help="ignore the manifest and rebuild every routine")
+    jokes_parser.set_defaults(func=jokes_table)
+
+    database_parser = commands.add_parser("database", help="build humor.db from data/ and transcripts/")
+    database_parser.add_argument("--db", default="humor.db")
+    database_parser.add_argument("--full", action="store_true", help="delete the database and rebuild it from scratch")
+    database_parser.set_defaults(func=database)
+
+    clusters_parser = commands.add_parser("clusters", help="link near-duplicate jokes in humor.db")
+    clusters_parser.add_argument("--db", default="humor.db")
+    clusters_parser.set_defaults(func=clusters)
+
+    topics_parser = commands.add_parser("topics", help="group embedded jokes into topics in humor.db")
+    topics_parser.add_argument("--db", default="humor.db")
+    topics_parser.add_argument("--refit", action="store_true", help="fit new centroids instead of assigning to the saved ones")
+    topics_parser.set_defaults(func=topics)
+
+    search_parser = commands.add_parser("search", help="BM25 keyword search over the saved index")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--index", default=CONFIG["search_index_path"])
+    search_parser.add_argument("-k", type=int, default=10)
+    search_parser.set_defaults(func=search)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import asyncio
+import weakref
+
+# clients are built on first use, importing a stage module never reads .env or needs an API key
+
+_env_loaded = False
+_openai_client = None
+_instructor_client = None
+# an async client keeps connections bound to the event loop it first ran in
+_async_instructor_clients = weakref.WeakKeyDictionary()
+
+
+def load_env():
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _env_loaded = True
+
+
+def openai_client():
+    global _openai_client
+    if _openai_client is None:
+        load_env()
+        from openai import OpenAI
+        _openai_client = OpenAI()
+    return _openai_client
+
+
+def instructor_client():
+    global _instructor_client
+    if _instructor_client is None:
+        import instructor
+        _instructor_client = instructor.from_openai(openai_client())
+    return _instructor_client
+
+
+def async_instructor_client():
+    loop = asyncio.get_running_loop()
+    client = _async_instructor_clients.get(loop)
+    if client is None:
+        load_env()
+        import instructor
+        from openai import AsyncOpenAI
+        client = _async_instructor_clients[loop] = instructor.from_openai(AsyncOpenAI())
+    return client
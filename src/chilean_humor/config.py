@@ -9,8 +9,44 @@ MAX_CONTEXT_LENGTHS = {
     "gpt-4o": 128000,
     "gpt-4-turbo": 128000,
 }
+MAX_OUTPUT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-4o": 16384,
+    "gpt-4-turbo": 4096,
+}
+
+# USD per million tokens, input and output
+TOKEN_PRICES = {
+    "gpt-4": (30.00, 60.00),
+    "gpt-4o": (5.00, 15.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+WHISPER_PRICE_PER_MINUTE = 0.006
+
+# Embeddings endpoint limits (per request)
+EMBEDDING_MAX_BATCH_SIZE = 2048
+EMBEDDING_MAX_BATCH_TOKENS = 300000
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+
+# jokes whose transcript match is at least this good link to the aligned start instead of the LLM timestamp
+ALIGNMENT_MIN_CONFIDENCE = 0.5
+
+# pipeline stages, per routine first then over the whole corpus
+ROUTINE_STAGES = ["transcript", "jokes", "refined"]
+GLOBAL_STAGES = ["jokes_table", "database", "clusters", "vector_index", "topics"]
 
 CONFIG = {
     "chat_model": "gpt-4o",
-    "embedding_model": "text-embedding-3-small"
-}
\ No newline at end of file
+    "embedding_model": "text-embedding-3-small",
+    "embedding_cache_path": ".cache/embeddings.sqlite",
+    "vector_store_path": "vector_store",
+    "topics_path": "topics",
+    "llm_cache_path": ".cache/llm.sqlite",
+    "llm_cache_max_bytes": 512 * 1024 * 1024,
+    "search_index_path": "search_index.npz",
+    "corpus_path": "corpus",
+    "pipeline_manifest_path": ".cache/pipeline_manifest.json",
+}
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from loguru import logger
+
+from chilean_humor.config import CONFIG
+from chilean_humor.utils import extract_number
+
+# one dataset per pipeline stage, hive partitioned as <stage>/year=YYYY/routine_id=N/
+# so filters on either column prune whole directories before any file is opened.
+# compact() also writes <stage>.arrow, a single memory-mapped snapshot that reads skip straight to
+SCHEMAS = {
+    "transcripts": pa.schema([
+        ("start_time", pa.float64()),
+        ("end_time", pa.float64()),
+        ("timestamp", pa.string()),
+        ("language", pa.string()),
+        ("from_whisper", pa.bool_()),
+        ("transcript", pa.string()),
+    ]),
+    "jokes": pa.schema([
+        ("position", pa.int32()),
+        ("start_timestamp", pa.string()),
+        ("transcript", pa.string()),
+        ("corrected_transcript", pa.string()),
+    ]),
+}
+SCHEMAS["jokes_refined"] = SCHEMAS["jokes"]
+
+# row order inside a routine
+ORDER = {"transcripts": "start_time", "jokes": "position", "jokes_refined": "position"}
+
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16()), ("routine_id", pa.int32())]), flavor="hive")
+
+# where the JSONL files of each stage live and how they are named
+JSONL_LAYOUT = {
+    "transcripts": ("transcripts", "routine_{}_transcript.jsonl"),
+    "jokes": ("jokes", "routine_{}_repertoire.jsonl"),
+    "jokes_refined": ("jokes_refined", "routine_{}_refined_repertoire.jsonl"),
+}
+
+
+def routine_years(routines_path: str = "data/routines.csv") -> Dict[int, int]:
+    routines = pd.read_csv(routines_path, usecols=["ID", "YEAR"])
+    return dict(zip(routines["ID"].astype(int), routines["YEAR"].astype(int)))
+
+
+class CorpusStore:
+    def __init__(self, root: str = CONFIG["corpus_path"], routines_path: str = "data/routines.csv"):
+        self.root = root
+        self.routines_path = routines_path
+        self.filesystem = fs.LocalFileSystem(use_mmap=True)
+        self._years = None
+
+    def year(self, routine_id: int) -> int:
+        if self._years is None:
+            self._years = routine_years(self.routines_path)
+        return self._years[routine_id]
+
+    def routine_dir(self, stage: str, routine_id: int) -> str:
+        return os.path.join(self.root, stage, f"year={self.year(routine_id)}", f"routine_id={routine_id}")
+
+    def snapshot_path(self, stage: str) -> str:
+        return os.path.join(self.root, f"{stage}.arrow")
+
+    def _invalidate(self, stage: str):
+        if os.path.exists(self.snapshot_path(stage)):
+            os.remove(self.snapshot_path(stage))
+
+    def _staging_path(self) -> str:
+        # next to the stage directories, never inside one, so a scan running meanwhile cannot see half-written files
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+
+    def _table(self, stage: str, records: List[dict]) -> pa.Table:
+        schema = SCHEMAS[stage]
+        if "position" in schema.names:
+            records = [{**record, "position": i} for i, record in enumerate(records)]
+        columns = {name: [record.get(name) for record in records] for name in schema.names}
+        return pa.Table.from_pydict(columns, schema=schema)
+
+    def write_routine(self, stage: str, routine_id: int, records: List[dict]):
+        # replaces the routine, the new file is complete before the old directory goes away
+        self._invalidate(stage)
+        path = self.routine_dir(stage, routine_id)
+        tmp = self._staging_path()
+        os.makedirs(tmp)
+        pq.write_table(self._table(stage, records), os.path.join(tmp, "part-0.parquet"))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+
+    def append_routine(self, stage: str, routine_id: int, records: List[dict]):
+        self._invalidate(stage)
+        path = self.routine_dir(stage, routine_id)
+        os.makedirs(path, exist_ok=True)
+        table = self._table(stage, records)
+        if "position" in table.column_names:
+            offset = self.count(stage, routine_ids=[routine_id])
+            table = table.set_column(table.schema.get_field_index("position"), "position", pc.add(table["position"], offset))
+        tmp = self._staging_path()
+        pq.write_table(table, tmp)
+        os.replace(tmp, os.path.join(path, f"part-{uuid.uuid4().hex}.parquet"))
+
+    def delete_routine(self, stage: str, routine_id: int):
+        self._invalidate(stage)
+        path = self.routine_dir(stage, routine_id)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def schema(self, stage: str) -> pa.Schema:
+        return SCHEMAS[stage].append(pa.field("year", pa.int16())).append(pa.field("routine_id", pa.int32()))
+
+    def dataset(self, stage: str, partitions: bool = False) -> ds.Dataset:
+        snapshot = self.snapshot_path(stage)
+        if not partitions and os.path.exists(snapshot):
+            return ds.dataset(snapshot, schema=self.schema(stage), format="ipc", filesystem=self.filesystem)
+        path = os.path.join(self.root, stage)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No {stage} corpus at {path}, run python -m chilean_humor.corpus --convert")
+        return ds.dataset(
+            path,
+            schema=self.schema(stage),
+            format="parquet",
+            partitioning=PARTITIONING,
+            filesystem=self.filesystem,
+            exclude_invalid_files=False,
+            ignore_prefixes=[".", "_"],
+        )
+
+    def _filter(self, routine_ids=None, years=None, filter=None):
+        expression = filter
+        for column, values in (("routine_id", routine_ids), ("year", years)):
+            if values is None:
+                continue
+            condition = ds.field(column).isin(list(values))
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def read(
+            self,
+            stage: str,
+            columns: Optional[List[str]] = None,
+            routine_ids: Optional[Iterable[int]] = None,
+            years: Optional[Iterable[int]] = None,
+            filter: Optional[ds.Expression] = None,
+        ) -> pa.Table:
+        return self.dataset(stage).to_table(columns=columns, filter=self._filter(routine_ids, years, filter))
+
+    def read_pandas(self, stage: str, **kwargs) -> pd.DataFrame:
+        return self.read(stage, **kwargs).to_pandas()
+
+    def read_routine(self, stage: str, routine_id: int) -> List[dict]:
+        table = self.read(stage, routine_ids=[routine_id])
+        if "position" in table.column_names:
+            table = table.sort_by("position")
+        return table.drop_columns(["year", "routine_id"]).to_pylist()
+
+    def compact(self, stage: str):
+        # one file per stage instead of one per routine, reading it is a memory map
+        table = self.dataset(stage, partitions=True).to_table()
+        table = table.sort_by([("routine_id", "ascending"), (ORDER[stage], "ascending")])
+        tmp = f"{self.snapshot_path(stage)}.tmp"
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=8192)
+        os.replace(tmp, self.snapshot_path(stage))
+
+    def count(self, stage: str, routine_ids: Optional[Iterable[int]] = None, years: Optional[Iterable[int]] = None) -> int:
+        if not os.path.exists(os.path.join(self.root, stage)):
+            return 0
+        return self.dataset(stage).count_rows(filter=self._filter(routine_ids, years))
+
+    def routine_ids(self, stage: str) -> List[int]:
+        path = os.path.join(self.root, stage)
+        if not os.path.exists(path):
+            return []
+        return sorted(
+            int(name.split("=", 1)[1])
+            for year in os.listdir(path) if year.startswith("year=")
+            for name in os.listdir(os.path.join(path, year)) if name.startswith("routine_id=")
+        )
+
+
+def read_jsonl(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def convert_jsonl(store: CorpusStore, stages: Iterable[str] = JSONL_LAYOUT):
+    # rewrites each stage from the JSONL files, routines without a file are dropped
+    for stage in stages:
+        folder, pattern = JSONL_LAYOUT[stage]
+        suffix = pattern.format("")[len("routine_"):]
+        routine_ids = sorted(extract_number(f) for f in os.listdir(folder) if f.endswith(suffix))
+        for routine_id in routine_ids:
+            store.write_routine(stage, routine_id, read_jsonl(os.path.join(folder, pattern.format(routine_id))))
+        for routine_id in set(store.routine_ids(stage)) - set(routine_ids):
+            store.delete_routine(stage, routine_id)
+        store.compact(stage)
+        logger.info(f"Converted {len(routine_ids)} routines into {stage}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parquet corpus of transcripts, jokes and refined jokes")
+    parser.add_argument("--root", default=CONFIG["corpus_path"])
+    parser.add_argument("--convert", action="store_true", help="rebuild the corpus from the JSONL folders")
+    parser.add_argument("--compact", action="store_true", help="rewrite the single-file snapshots after appends")
+    parser.add_argument("--stage", choices=list(JSONL_LAYOUT), action="append")
+    args = parser.parse_args()
+
+    store = CorpusStore(args.root)
+    stages = args.stage or list(JSONL_LAYOUT)
+    if args.convert:
+        convert_jsonl(store, stages)
+    elif args.compact:
+        for stage in stages:
+            store.compact(stage)
+
+    for stage in stages:
+        start = time.perf_counter()
+        table = store.read(stage)
+        logger.info(f"{stage}: {table.num_rows} rows from {len(store.routine_ids(stage))} routines in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import itertools
+import re
+import time
+import unicodedata
+
+import numpy as np
+
+# Near-duplicate jokes with MinHash and LSH. Standalone like build_database.py, CI runs it right after
+
+NUM_PERM = 128
+# 32 bands of 4 rows: pairs above ~0.42 Jaccard share a band with high probability
+BANDS = 32
+SHINGLE = 5
+THRESHOLD = 0.5
+SEED = 1
+# buckets bigger than this are boilerplate ("[Música]", empty texts), not jokes told twice
+MAX_BUCKET = 200
+
+PRIME = (1 << 31) - 1
+PARAMS = f"minhash:{NUM_PERM}:{SHINGLE}:{SEED}"
+NON_WORD = re.compile(r"[^a-z0-9\s]")
+
+_rng = np.random.default_rng(SEED)
+A = _rng.integers(1, PRIME, NUM_PERM, dtype=np.uint64)
+B = _rng.integers(0, PRIME, NUM_PERM, dtype=np.uint64)
+
+
+def normalize(text):
+    # accents and punctuation are transcription noise, "¿Cómo?" and "como" are the same shingles
+    text = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+    return " ".join(NON_WORD.sub(" ", text).split())
+
+
+def signature_key(text):
+    return hashlib.sha256(f"{PARAMS}\n{normalize(text)}".encode("utf-8")).hexdigest()
+
+
+def shingle_hashes(text, k=SHINGLE):
+    codes = np.frombuffer(normalize(text).encode("ascii"), dtype=np.uint8).astype(np.uint64)
+    if len(codes) == 0:
+        return codes
+    k = min(k, len(codes))
+    n = len(codes) - k + 1
+    hashes = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * np.uint64(257) + codes[j:j + n]
+    return np.unique(hashes % np.uint64(PRIME))
+
+
+def signature(text):
+    hashes = shingle_hashes(text)
+    if len(hashes) == 0:
+        return np.full(NUM_PERM, PRIME, dtype=np.uint32)
+    # (a * x + b) mod p stays below 2**63 because a, x and b are below 2**31
+    return ((A[:, None] * hashes[None, :] + B[:, None]) % np.uint64(PRIME)).min(axis=1).astype(np.uint32)
+
+
+def shingle_set(text):
+    return set(shingle_hashes(text).tolist())
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class SignatureStore:
+    # signatures are kept next to the jokes, a new routine only hashes its own jokes
+    def __init__(self, db):
+        self.db = db
+        db.execute('CREATE TABLE IF NOT EXISTS "_minhash" ("KEY" TEXT PRIMARY KEY, "SIGNATURE" BLOB NOT NULL)')
+
+    def get_many(self, keys):
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        # stay below SQLite's default limit of bound parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            for key, blob in self.db.execute(f'SELECT "KEY", "SIGNATURE" FROM "_minhash" WHERE "KEY" IN ({placeholders})', batch):
+                found[key] = np.frombuffer(blob, dtype=np.uint32)
+        return found
+
+    def put_many(self, items):
+        with self.db.conn:
+            self.db.conn.executemany('INSERT OR REPLACE INTO "_minhash" ("KEY", "SIGNATURE") VALUES (?, ?)', [(key, sig.tobytes()) for key, sig in items])
+
+    def prune(self, keep):
+        # signatures of jokes that are gone, so the table does not grow forever
+        keep = set(keep)
+        stale = [key for (key,) in self.db.execute('SELECT "KEY" FROM "_minhash"') if key not in keep]
+        with self.db.conn:
+            self.db.conn.executemany('DELETE FROM "_minhash" WHERE "KEY" = ?', [(key,) for key in stale])
+        return len(stale)
+
+
+def signatures(texts, store=None):
+    keys = [signature_key(text) for text in texts]
+    found = store.get_many(keys) if store else {}
+    computed = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in computed:
+            computed[key] = signature(text)
+    if store and computed:
+        store.put_many(computed.items())
+    found.update(computed)
+    matrix = np.stack([found[key] for key in keys]) if keys else np.zeros((0, NUM_PERM), dtype=np.uint32)
+    return matrix, keys, len(computed)
+
+
+def band_keys(signatures, band, rows):
+    # one integer per band, collisions only add candidates that verification drops
+    key = np.zeros(len(signatures), dtype=np.uint64)
+    for column in signatures[:, band * rows:(band + 1) * rows].T:
+        key = (key * np.uint64(1000003)) ^ column.astype(np.uint64)
+    return key
+
+
+def candidate_pairs(signatures, bands=BANDS, max_bucket=MAX_BUCKET):
+    n = len(signatures)
+    rows = signatures.shape[1] // bands
+    pairs = set()
+    for band in range(bands):
+        keys = band_keys(signatures, band, rows)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        sizes = np.diff(np.r_[starts, n])
+        for start, size in zip(starts[(sizes > 1) & (sizes <= max_bucket)], sizes[(sizes > 1) & (sizes <= max_bucket)]):
+            members = np.sort(order[start:start + size])
+            pairs.update(itertools.combinations(members.tolist(), 2))
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    left, right = np.array(sorted(pairs), dtype=np.int64).T
+    return left, right
+
+
+def similar_pairs(signatures, threshold=THRESHOLD, bands=BANDS):
+    left, right = candidate_pairs(signatures, bands)
+    similarity = (signatures[left] == signatures[right]).mean(axis=1)
+    keep = similarity >= threshold
+    return left[keep], right[keep], similarity[keep]
+
+
+def clusters(n, left, right, similarity):
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    best = np.zeros(n)
+    for i, j, s in zip(left.tolist(), right.tolist(), similarity.tolist()):
+        parent[max(find(i), find(j))] = min(find(i), find(j))
+        best[i] = max(best[i], s)
+        best[j] = max(best[j], s)
+    roots = [find(i) for i in range(n)]
+    sizes = np.bincount(roots, minlength=n)
+    return roots, sizes, best
+
+
+def build_clusters(db_path="humor.db", threshold=THRESHOLD, prune=True):
+    # sqlite_utils loads pandas when it is installed, only worth paying for when clusters are built
+    import sqlite_utils
+    start = time.perf_counter()
+    db = sqlite_utils.Database(db_path)
+    jokes = db.execute('SELECT "ID", "TEXT" FROM "jokes" ORDER BY "ID"').fetchall()
+    ids = [joke_id for joke_id, _ in jokes]
+
+    store = SignatureStore(db)
+    matrix, keys, computed = signatures([text or "" for _, text in jokes], store)
+    if prune:
+        store.prune(keys)
+    left, right, similarity = similar_pairs(matrix, threshold)
+    roots, sizes, best = clusters(len(ids), left, right, similarity)
+
+    # the cluster id is the smallest joke id in it, jokes without a near-duplicate are left out
+    rows = [
+        {"JOKEID": ids[i], "CLUSTERID": ids[root], "CLUSTERSIZE": int(sizes[root]), "SIMILARITY": round(float(best[i]), 3)}
+        for i, root in enumerate(roots)
+        if sizes[root] > 1
+    ]
+    with db.conn:
+        if "joke_clusters" in db.table_names():
+            db["joke_clusters"].drop()
+        db["joke_clusters"].create(
+            {"JOKEID": int, "CLUSTERID": int, "CLUSTERSIZE": int, "SIMILARITY": float},
+            pk="JOKEID",
+            foreign_keys=[("JOKEID", "jokes", "ID")],
+        )
+        db["joke_clusters"].insert_all(rows)
+    db["joke_clusters"].create_index(["CLUSTERID"], if_not_exists=True)
+
+    n_clusters = len({row["CLUSTERID"] for row in rows})
+    print(f"Linked {len(rows)} jokes into {n_clusters} clusters ({computed} new signatures, {len(left)} pairs) in {time.perf_counter() - start:.2f}s")
+    return n_clusters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Link near-duplicate jokes in humor.db into joke_clusters")
+    parser.add_argument("--db", default="humor.db")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="estimated Jaccard similarity of character shingles")
+    args = parser.parse_args()
+    build_clusters(args.db, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,26 @@
 # Code from here: https://github.com/jxnl/youtubechapters-backend
 
-from pytube import YouTube
+from contextlib import contextmanager
 from tempfile import TemporaryDirectory
 from loguru import logger
 
 
-def download_youtube_video(url):
+def download_youtube_video(url, output_path):
+    from pytube import YouTube
+
     logger.info(f"Downloading {url}...")
+    file_name = (
+        YouTube(url)
+        .streams.filter(only_audio=True, file_extension="mp4")
+        .first()
+        .download(output_path=output_path)
+    )
+    logger.info(f"Downloaded {url} to {file_name}")
+    return file_name
+
+
+@contextmanager
+def downloaded_audio(url):
+    # the audio and anything cut from it next to it are deleted when the block exits, even on errors
     with TemporaryDirectory() as tmpdir:
-        file_name = (
-            YouTube(url)
-            .streams.filter(only_audio=True, file_extension="mp4")
-            .first()
-            .download(output_path="./tmp")
-        )
-        logger.info(f"Downloaded {url} to {file_name}")
-        return file_name
\ No newline at end of file
+        yield download_youtube_video(url, tmpdir)
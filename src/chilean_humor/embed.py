@@ -1,12 +1,18 @@
-from openai import OpenAI
 from pydantic import BaseModel
+from typing import Iterator, List, Optional
+from loguru import logger
 import datetime
-from chilean_humor.config import CONFIG
-
-from dotenv import load_dotenv
-load_dotenv()
-
-client = OpenAI()
+from chilean_humor.cache import EmbeddingCache, normalize_text, text_hash
+from chilean_humor.clients import openai_client
+from chilean_humor.instrument import instrumented, metrics, record_usage
+from chilean_humor.utils import estimate_tokens
+from chilean_humor.config import (
+    ALIGNMENT_MIN_CONFIDENCE,
+    CONFIG,
+    EMBEDDING_MAX_BATCH_SIZE,
+    EMBEDDING_MAX_BATCH_TOKENS,
+    EMBEDDING_MAX_INPUT_TOKENS,
+)
 
 class JokeChunk(BaseModel):
     routine_id: int
@@ -16,23 +22,90 @@ class JokeChunk(BaseModel):
     start_timestamp: datetime.time
     text: str
     video_id: str
+    aligned_start: Optional[float] = None
+    alignment_confidence: Optional[float] = None
+    joke_id: Optional[int] = None
+
 
 class EmbedJokeChunks:
-    def __init__(self, model_name: str = CONFIG["embedding_model"]):
+    def __init__(
+        self,
+        model_name: str = CONFIG["embedding_model"],
+        embedding_client=None,
+        cache: Optional[EmbeddingCache] = None,
+        batch_size: int = EMBEDDING_MAX_BATCH_SIZE,
+        max_batch_tokens: int = EMBEDDING_MAX_BATCH_TOKENS,
+    ):
         self.embedding_model = model_name
-    
+        self._client = embedding_client
+        self.cache = cache
+        self.batch_size = min(batch_size, EMBEDDING_MAX_BATCH_SIZE)
+        self.max_batch_tokens = min(max_batch_tokens, EMBEDDING_MAX_BATCH_TOKENS)
+
+    @property
+    def client(self):
+        # a run where every text is cached never needs an API key
+        if self._client is None:
+            self._client = openai_client()
+        return self._client
+
     def __call__(self, chunk: JokeChunk):
-        text = chunk.text
-        text = text.replace("\n", " ")
-        embedding = client.embeddings.create(input = [text], model=self.embedding_model).data[0].embedding
+        return self.embed_batch([chunk])[0]
+
+    def embed_batch(self, chunks: List[JokeChunk]) -> List[dict]:
+        texts = [normalize_text(chunk.text) for chunk in chunks]
+        embeddings = self.embed_texts(texts)
+        return [self._to_record(chunk, text, embedding) for chunk, text, embedding in zip(chunks, texts, embeddings)]
+
+    # __call__ and embed_batch both end up here
+    @instrumented("embed")
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        found = self.cache.get_many(self.embedding_model, hashes) if self.cache else {}
+        metrics.count("embed", "cache_hits", sum(1 for h in hashes if h in found))
+
+        # identical jokes are only sent once
+        pending = {}
+        for h, text in zip(hashes, texts):
+            if h not in found and h not in pending:
+                pending[h] = normalize_text(text)
+
+        batches = list(self._batches(list(pending.items())))
+        for i, batch in enumerate(batches):
+            logger.info(f"Embedding batch {i+1}/{len(batches)} ({len(batch)} texts)")
+            response = self.client.embeddings.create(input=[text for _, text in batch], model=self.embedding_model)
+            record_usage("embed", self.embedding_model, response)
+            embedded = [(batch[d.index][0], d.embedding) for d in response.data]
+            found.update(embedded)
+            if self.cache:
+                self.cache.put_many(self.embedding_model, embedded)
+
+        return [found[h] for h in hashes]
+
+    def _batches(self, items) -> Iterator[list]:
+        batch, batch_tokens = [], 0
+        for h, text in items:
+            tokens = min(estimate_tokens(text), EMBEDDING_MAX_INPUT_TOKENS)
+            if batch and (len(batch) >= self.batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append((h, text))
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def _to_record(self, chunk: JokeChunk, text: str, embedding: List[float]) -> dict:
         t = chunk.start_timestamp
         start_time= (t.hour * 60 + t.minute) * 60 + t.second
+        if chunk.alignment_confidence is not None and chunk.alignment_confidence >= ALIGNMENT_MIN_CONFIDENCE:
+            start_time = int(chunk.aligned_start)
 
         return {"text": text,
+                "joke_id": chunk.joke_id,
                 "start_time": start_time,
                 "routine_id": chunk.routine_id,
                 "show_id": chunk.show_id,
                 "event_name": chunk.event_name,
                 "show_name": chunk.show_name,
                 "url": f"https://www.youtube.com/watch?v={chunk.video_id}&start={start_time}",
-                "embedding": embedding}
\ No newline at end of file
+                "embedding": embedding}
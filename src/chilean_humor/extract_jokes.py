@@ -1,39 +1,160 @@
+import argparse
+import asyncio
+import os
 from loguru import logger
-from typing import List
+from typing import List, Optional
 
-from chilean_humor.segment import extract_jokes_from_segments, Segment
+from chilean_humor.instrument import routine_scope
+from chilean_humor.joke import Joke, Repertoire
+from chilean_humor.packing import TokenBudget, count_tokens, merge_overlapping, pack_segments, prompt_overhead
+from chilean_humor.ratelimit import RateLimiter
+from chilean_humor.segment import (
+    aextract_jokes_from_blocks,
+    aextract_jokes_from_segments,
+    extract_jokes_from_blocks,
+    extract_jokes_from_segments,
+    split_prompt_blocks,
+    Segment,
+)
+from chilean_humor.utils import atomic_write, extract_number
 
 
 def extract_repertories(
         segments: List[Segment],
+        budget: Optional[TokenBudget] = None,
+    ) -> List[Repertoire]:
+    if budget is None:
+        return extract_jokes_from_segments(segments = segments)
+    blocks = pack_segments(segments, budget)
+    return merge_overlapping(blocks, extract_jokes_from_blocks([block.text for block in blocks]))
+
+def read_segments(routine_id: int) -> List[Segment]:
+    filename = f"transcripts/routine_{routine_id}_transcript.jsonl"
+    segments = []
+
+    with open(filename, "r", encoding="utf-8") as file:
+        for line in file:
+            segment = Segment.from_json(line)
+            segments.append(segment)
+    return segments
+
+def repertoire_path(routine_id: int) -> str:
+    return f"jokes/routine_{routine_id}_repertoire.jsonl"
+
+def pending_routine_ids(folder: str = "transcripts") -> List[int]:
+    # a repertoire file only exists once its routine was fully extracted
+    routine_ids = sorted(extract_number(f) for f in os.listdir(folder) if f.endswith("_transcript.jsonl"))
+    return [routine_id for routine_id in routine_ids if not os.path.exists(repertoire_path(routine_id))]
+
+def write_jokes(routine_id: int, jokes: List[Joke]):
+    with atomic_write(repertoire_path(routine_id)) as file:
+        for joke in jokes:
+            if len(joke.corrected_transcript) > 0:
+                file.write(joke.json() + "\n")
+
+async def aextract_routine(
+        routine_id: int,
+        semaphore: asyncio.Semaphore,
+        limiter: Optional[RateLimiter] = None,
+        client=None,
+        budget: Optional[TokenBudget] = None,
+    ):
+    logger.info(f"Extracting jokes for routine {routine_id}.")
+    segments = read_segments(routine_id)
+    if budget is None:
+        repertoires = await aextract_jokes_from_segments(segments, semaphore=semaphore, limiter=limiter, client=client)
+    else:
+        blocks = pack_segments(segments, budget)
+        repertoires = await aextract_jokes_from_blocks([block.text for block in blocks], semaphore, limiter, client, budget.output_ratio)
+        repertoires = merge_overlapping(blocks, repertoires)
+    jokes = [joke for r in repertoires for joke in r.jokes]
+    jokes.sort(key=lambda joke: joke.start_timestamp)
+    write_jokes(routine_id, jokes)
+    logger.info(f"Wrote {len(jokes)} jokes for routine {routine_id}.")
+
+async def aextract_routines(
+        routine_ids: List[int],
+        concurrency: int = 8,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        client=None,
+        budget: Optional[TokenBudget] = None,
     ):
-    repertoires = extract_jokes_from_segments(segments = segments)
-    return repertoires
+    # one semaphore and one limiter for every block of every routine
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+    async def extract(routine_id):
+        # every routine is its own task, so its LLM cost is attributed to it outside the pipeline too
+        with routine_scope(routine_id):
+            await aextract_routine(routine_id, semaphore, limiter, client, budget)
+
+    results = await asyncio.gather(*[extract(routine_id) for routine_id in routine_ids], return_exceptions=True)
+    for routine_id, result in zip(routine_ids, results):
+        if isinstance(result, Exception):
+            logger.info(f"Error extracting jokes for {routine_id} {result}")
+
+def packing_report(routine_ids: List[int], budget: TokenBudget, chunk: int = 300 * 10):
+    # calls and prompt tokens per routine, fixed-size character chunks vs token-budget packing
+    overhead = prompt_overhead(budget.model)
+    logger.info(f"Input budget per call: {budget.input_tokens()} tokens, prompt overhead {overhead} tokens")
+    print(f"{'routine':>8} {'calls before':>13} {'tokens before':>14} {'calls after':>12} {'tokens after':>13}")
+    totals = [0, 0, 0, 0]
+    for routine_id in routine_ids:
+        segments = read_segments(routine_id)
+        legacy = split_prompt_blocks(segments, chunk=chunk)
+        packed = pack_segments(segments, budget)
+        row = [
+            len(legacy),
+            sum(count_tokens(text, budget.model) + overhead for text in legacy),
+            len(packed),
+            sum(block.tokens + overhead for block in packed),
+        ]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{routine_id:>8} {row[0]:>13} {row[1]:>14} {row[2]:>12} {row[3]:>13}")
+    print(f"{'total':>8} {totals[0]:>13} {totals[1]:>14} {totals[2]:>12} {totals[3]:>13}")
 
 def main():
-    routine_ids = [172]
+    parser = argparse.ArgumentParser(description="Extract jokes from routine transcripts")
+    parser.add_argument("routine_ids", type=int, nargs="*", help="defaults to every routine without a repertoire")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=float, default=None, help="requests per minute")
+    parser.add_argument("--tpm", type=float, default=None, help="tokens per minute")
+    parser.add_argument("--sequential", action="store_true", help="one block at a time, no concurrency")
+    parser.add_argument("--model", default=TokenBudget.model)
+    parser.add_argument("--context-share", type=float, default=TokenBudget.context_share, help="share of the context window a call may use")
+    parser.add_argument("--output-share", type=float, default=TokenBudget.output_share, help="share of the output limit the answer may use")
+    parser.add_argument("--overlap", type=int, default=TokenBudget.overlap, help="segments repeated at block boundaries")
+    parser.add_argument("--legacy-chunks", action="store_true", help="fixed 3000 character blocks instead of token packing")
+    parser.add_argument("--report", action="store_true", help="print calls and tokens per routine before and after packing, without calling the LLM")
+    args = parser.parse_args()
+
+    budget = None if args.legacy_chunks else TokenBudget(args.model, args.context_share, args.output_share, overlap=args.overlap)
+
+    if args.report:
+        routine_ids = args.routine_ids or sorted(extract_number(f) for f in os.listdir("transcripts") if f.endswith("_transcript.jsonl"))
+        packing_report(routine_ids, budget or TokenBudget())
+        return
+
+    routine_ids = args.routine_ids or pending_routine_ids()
+
+    if not args.sequential:
+        asyncio.run(aextract_routines(routine_ids, args.concurrency, args.rpm, args.tpm, budget=budget))
+        return
 
     for routine_id in routine_ids:
-        filename = f"transcripts/routine_{routine_id}_transcript.jsonl"
-        segments = []
-
-        with open(filename, "r", encoding="utf-8") as file:
-            for line in file:
-                segment = Segment.from_json(line)
-                segments.append(segment)
-        repertoires = extract_repertories(segments = segments)
-
-        for r in repertoires:
-            for joke in r.jokes:
-                try:
-                    if len(joke.corrected_transcript) > 0:
-                        with open(f"jokes/routine_{routine_id}_repertoire.jsonl", "a", encoding="utf-8") as file:
-                            json_line = joke.json()
-                            file.write(json_line + "\n")
-                except Exception as e:
-                    logger.info(f"Error writing joke for {routine_id} {e}")
-                    continue
+        try:
+            repertoires = extract_repertories(segments = read_segments(routine_id), budget = budget)
+        except Exception as e:
+            logger.info(f"Error extracting jokes for {routine_id} {e}")
+            continue
+        jokes = [joke for r in repertoires for joke in r.jokes]
+        try:
+            write_jokes(routine_id, jokes)
+        except Exception as e:
+            logger.info(f"Error writing joke for {routine_id} {e}")
+            continue
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import copy
+import json
+import math
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from chilean_humor.joke import Joke
+from chilean_humor.search import fold_accents
+from chilean_humor.utils import extract_routines_ids, read_jokes, timestamp_seconds
+
+
+def char_ngrams(text: str, n: int = 4) -> Counter:
+    text = " ".join(fold_accents(text).split())
+    return Counter(text[i:i + n] for i in range(max(len(text) - n + 1, 1)))
+
+
+class ContinuityGate:
+    # answers True/False for pairs that are obviously (un)related, None when the LLM should decide
+    def __init__(
+        self,
+        low_similarity: float = 0.05,
+        high_similarity: Optional[float] = None,
+        min_gap: float = 60.0,
+        ngram: int = 4,
+    ):
+        self.low_similarity = low_similarity
+        self.high_similarity = high_similarity
+        self.min_gap = min_gap
+        self.ngram = ngram
+        self.idf: Dict[str, float] = {}
+
+    def fit(self, texts: List[str]) -> "ContinuityGate":
+        # idf over the routine being refined, shared catchphrases of a comedian weigh less.
+        # returns a fitted copy so routines refined concurrently don't share state
+        document_frequency = Counter()
+        for text in texts:
+            document_frequency.update(char_ngrams(text, self.ngram).keys())
+        n = len(texts)
+        fitted = copy.copy(self)
+        fitted.idf = {gram: math.log((1 + n) / (1 + df)) + 1 for gram, df in document_frequency.items()}
+        return fitted
+
+    def _vector(self, text: str) -> Dict[str, float]:
+        counts = char_ngrams(text, self.ngram)
+        vector = {gram: count * self.idf.get(gram, 1.0) for gram, count in counts.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        return {gram: v / norm for gram, v in vector.items()}
+
+    def similarity(self, text1: str, text2: str) -> float:
+        v1, v2 = self._vector(text1), self._vector(text2)
+        if len(v1) > len(v2):
+            v1, v2 = v2, v1
+        return sum(value * v2.get(gram, 0.0) for gram, value in v1.items())
+
+    def decide(self, joke1: Joke, joke2: Joke) -> Optional[bool]:
+        similarity = self.similarity(joke1.corrected_transcript, joke2.corrected_transcript)
+        if self.high_similarity is not None and similarity >= self.high_similarity:
+            return True
+        gap = timestamp_seconds(joke2.start_timestamp) - timestamp_seconds(joke1.start_timestamp)
+        if similarity < self.low_similarity and gap >= self.min_gap:
+            return False
+        return None
+
+
+def past_decisions(raw: List[Joke], refined: List[Joke]) -> Optional[List[bool]]:
+    # recover the LLM outcome for each adjacent raw pair from how refine_jokes fused them
+    labels = []
+    i = 0
+    for joke in refined:
+        if i >= len(raw):
+            return None
+        transcript = raw[i].transcript
+        i += 1
+        while transcript != joke.transcript and i < len(raw) and len(transcript) < len(joke.transcript):
+            labels.append(True)
+            transcript += " " + raw[i].transcript
+            i += 1
+        if transcript != joke.transcript:
+            return None
+        if i < len(raw):
+            labels.append(False)
+    return labels if i == len(raw) else None
+
+
+def evaluate(gate: ContinuityGate, jokes_folder: str = "jokes", refined_folder: str = "jokes_refined") -> Dict[str, float]:
+    # agreement is measured on the pairs the gate answers locally, coverage is the share of calls saved
+    confusion: Dict[Tuple[bool, bool], int] = Counter()
+    pairs = skipped_routines = 0
+    for routine_id in sorted(extract_routines_ids(folder=jokes_folder)):
+        refined_file = os.path.join(refined_folder, f"routine_{routine_id}_refined_repertoire.jsonl")
+        if not os.path.exists(refined_file):
+            continue
+        raw = read_jokes(os.path.join(jokes_folder, f"routine_{routine_id}_repertoire.jsonl"))
+        labels = past_decisions(raw, read_jokes(refined_file))
+        if labels is None:
+            skipped_routines += 1
+            continue
+
+        fitted = gate.fit([joke.corrected_transcript for joke in raw])
+        for (joke1, joke2), label in zip(zip(raw, raw[1:]), labels):
+            pairs += 1
+            decision = fitted.decide(joke1, joke2)
+            if decision is not None:
+                confusion[(decision, label)] += 1
+
+    decided = sum(confusion.values())
+    agreed = confusion[(True, True)] + confusion[(False, False)]
+    return {
+        "pairs": pairs,
+        "decided_locally": decided,
+        "coverage": decided / pairs if pairs else 0.0,
+        "agreement": agreed / decided if decided else 0.0,
+        "false_splits": confusion[(False, True)],
+        "false_fusions": confusion[(True, False)],
+        "skipped_routines": skipped_routines,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the local continuity gate against past LLM decisions")
+    parser.add_argument("--low-similarity", type=float, default=0.05)
+    parser.add_argument("--high-similarity", type=float, default=None)
+    parser.add_argument("--min-gap", type=float, default=60.0, help="seconds between joke starts")
+    parser.add_argument("--ngram", type=int, default=4)
+    args = parser.parse_args()
+
+    gate = ContinuityGate(args.low_similarity, args.high_similarity, args.min_gap, args.ngram)
+    report = evaluate(gate)
+    logger.info(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,100 @@
+import argparse
 import os
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
 from loguru import logger
+from chilean_humor.instrument import metrics, routine_scope
 from chilean_humor.transcribe import transcribe_youtube
-from chilean_humor.segment import group_speech_segments
-from chilean_humor.utils import extract_video_id
+from chilean_humor.segment import iter_group_speech_segments
+from chilean_humor.utils import atomic_write, extract_video_id, retry
 
 
 def download_transcript(
         url: str,
+        transcript_api=None,
     ):
     video_id = extract_video_id(url)
-    phrases = transcribe_youtube(video_id)
-    phrases = group_speech_segments(phrases, max_length=300)
-    return phrases
+    phrases = transcribe_youtube(video_id, transcript_api=transcript_api)
+    return iter_group_speech_segments(phrases, max_length=300)
 
-def main():
+def transcript_path(routine_id: int) -> str:
+    return f"transcripts/routine_{routine_id}_transcript.jsonl"
 
-    routines_df = pd.read_csv("data/routines.csv")
+def write_transcript(routine_id: int, url: str, transcript_api=None):
+    phrases = download_transcript(url, transcript_api=transcript_api)
 
-    # filter routines with no youtube video
-    routines_df = routines_df[routines_df['VIDEO'].notnull()]
+    logger.info(f"Downloading transcript for {url}")
+    # phrases are grouped while they are written, a failure midway leaves no file behind
+    with atomic_write(transcript_path(routine_id)) as file:
+        for phrase in phrases:
+            json_line = phrase.to_json()
+            file.write(json_line + "\n")
+
+def fetch_transcript(routine_id: int, url: str, retries: int = 3, base_delay: float = 1.0, transcript_api=None):
+    def on_retry(attempt, error, delay):
+        logger.info(f"Retrying transcript for routine {routine_id} in {delay:.1f}s ({attempt}/{retries}) {error}")
+        metrics.count("transcribe_youtube", "retries")
+
+    # runs in worker threads, the routine is set here rather than inherited
+    with routine_scope(routine_id):
+        retry(lambda: write_transcript(routine_id, url, transcript_api), retries=retries, base_delay=base_delay, on_retry=on_retry)
 
-    for index, row in routines_df.iterrows():
+def fetch_transcripts(
+        routines: Dict[int, str],
+        workers: int = 8,
+        retries: int = 3,
+        base_delay: float = 1.0,
+        overwrite: bool = False,
+        transcript_api=None,
+    ) -> Dict[str, List]:
+    summary = {"fetched": [], "skipped": [], "failed": []}
+    pending = {}
+    for routine_id, url in routines.items():
+        if not overwrite and os.path.exists(transcript_path(routine_id)):
+            summary["skipped"].append(routine_id)
+        else:
+            pending[routine_id] = url
 
-        try:
-            url = row['VIDEO']
-            file_path = f"transcripts/routine_{row['ID']}_transcript.jsonl"
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_transcript, routine_id, url, retries, base_delay, transcript_api): routine_id
+            for routine_id, url in pending.items()
+        }
+        for future in as_completed(futures):
+            routine_id = futures[future]
+            try:
+                future.result()
+                summary["fetched"].append(routine_id)
+            except Exception as e:
+                logger.info(f"Error downloading transcript for routine {routine_id} {routines[routine_id]} {e}")
+                summary["failed"].append(routine_id)
 
-            if os.path.exists(file_path):
-                logger.info(f"Transcript already exists for {url}")
-                continue
+    for ids in summary.values():
+        ids.sort()
+    return summary
 
-            phrases = download_transcript(url)
+def main():
+    parser = argparse.ArgumentParser(description="Fetch YouTube transcripts for every routine with a video")
+    parser.add_argument("routine_ids", type=int, nargs="*", help="defaults to every routine with a video")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--overwrite", action="store_true", help="fetch again even when the transcript exists")
+    args = parser.parse_args()
+
+    import pandas as pd
+    routines_df = pd.read_csv("data/routines.csv")
+
+    # filter routines with no youtube video
+    routines_df = routines_df[routines_df['VIDEO'].notnull()]
+    routines = dict(zip(routines_df["ID"].astype(int), routines_df["VIDEO"]))
+    if args.routine_ids:
+        routines = {routine_id: url for routine_id, url in routines.items() if routine_id in args.routine_ids}
 
-            logger.info(f"Downloading transcript for {url}")
-            with open(file_path, "w", encoding="utf-8") as file:
-                for phrase in phrases:
-                    json_line = phrase.to_json()
-                    file.write(json_line + "\n")
-        except Exception as e:
-            logger.info(f"Error downloading transcript for {url} {e}")
+    summary = fetch_transcripts(routines, args.workers, args.retries, overwrite=args.overwrite)
+    logger.info(f"Fetched {len(summary['fetched'])}, skipped {len(summary['skipped'])}, failed {len(summary['failed'])} routines")
+    if summary["failed"]:
+        logger.info(f"Failed routines: {summary['failed']}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
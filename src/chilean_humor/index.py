@@ -1,33 +1,102 @@
 import os
-import psycopg2
-from pgvector.psycopg2 import register_vector
+import time
+from contextlib import contextmanager
 from loguru import logger
-from dotenv import load_dotenv
 
+from chilean_humor.clients import load_env
 from chilean_humor.config import EMBEDDING_DIMENSIONS, CONFIG
+from chilean_humor.instrument import instrumented, metrics
 
-# Load .env file
-load_dotenv()
+# psycopg2 and pgvector are imported on first use, only the vector_index stage needs Postgres
 
-def store_pg_results(chunk):
-    with psycopg2.connect(os.environ["DB_CONNECTION_STRING"]) as conn:
+CLIP_COLUMNS = ("routine_id", "show_id", "event_name", "show_name", "start_time", "text", "url", "embedding")
+
+_pool = None
+
+
+def get_pool(minconn: int = 1, maxconn: int = 4):
+    global _pool
+    if _pool is None or _pool.closed:
+        from psycopg2.pool import SimpleConnectionPool
+        load_env()
+        _pool = SimpleConnectionPool(minconn, maxconn, os.environ["DB_CONNECTION_STRING"])
+    return _pool
+
+
+@contextmanager
+def pooled_connection():
+    from pgvector.psycopg2 import register_vector
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
         with conn.cursor() as cur:
             cur.execute('CREATE EXTENSION IF NOT EXISTS vector')
-            register_vector(conn)
-            #embedding_json = json.dumps(chunk['embedding'])
-            cur.execute("INSERT INTO clips (routine_id, show_id, event_name, show_name, start_time, text, url, embedding) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", (chunk['routine_id'], chunk['show_id'], chunk['event_name'], chunk['show_name'], chunk['start_time'], chunk['text'], chunk['url'], chunk['embedding']))
+        register_vector(conn)
+        conn.commit()
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def create_clips_table(cur, embedding_model_name=CONFIG["embedding_model"]):
+    cur.execute("DROP TABLE IF EXISTS clips;")
+    cur.execute(f'CREATE TABLE clips (id serial primary key, routine_id int, show_id int, event_name text, show_name text, start_time float, "text" text not null, url text, embedding vector({EMBEDDING_DIMENSIONS[embedding_model_name]}));')
+
 
+def create_clips_index(cur, method="hnsw"):
+    if method == "hnsw":
+        cur.execute("CREATE INDEX clips_embedding_idx ON clips USING hnsw (embedding vector_cosine_ops);")
+    elif method == "ivfflat":
+        # pgvector recommends rows / 1000 lists for tables up to 1M rows
+        cur.execute("SELECT count(*) FROM clips;")
+        lists = max(1, cur.fetchone()[0] // 1000)
+        cur.execute(f"CREATE INDEX clips_embedding_idx ON clips USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists});")
+    elif method is not None:
+        raise ValueError(f"Unknown index method {method}")
 
-def set_index(embedded_chunks, embedding_model_name=CONFIG["embedding_model"]):
+
+@instrumented("bulk_store")
+def bulk_store(cur, chunks, batch_size=500) -> int:
+    from psycopg2.extras import execute_values
+    rows = 0
+    for start in range(0, len(chunks), batch_size):
+        batch = chunks[start:start + batch_size]
+        execute_values(
+            cur,
+            f"INSERT INTO clips ({', '.join(CLIP_COLUMNS)}) VALUES %s",
+            [tuple(chunk[column] for column in CLIP_COLUMNS) for chunk in batch],
+            page_size=batch_size,
+        )
+        rows += len(batch)
+        metrics.count("bulk_store", "rows", len(batch))
+        logger.info(f"Stored {rows}/{len(chunks)} chunks")
+    return rows
+
+
+def store_pg_results(chunk):
+    with pooled_connection() as conn:
+        with conn, conn.cursor() as cur:
+            bulk_store(cur, [chunk])
+
+
+@instrumented("set_index")
+def set_index(embedded_chunks, embedding_model_name=CONFIG["embedding_model"], batch_size=500, index_method="hnsw"):
     logger.info("Setting index")
+    embedded_chunks = list(embedded_chunks)
+    start = time.perf_counter()
 
-    with psycopg2.connect(os.environ["DB_CONNECTION_STRING"]) as conn:
-        with conn.cursor() as cur:
-            cur.execute('CREATE EXTENSION IF NOT EXISTS vector')
-            register_vector(conn)
-            cur.execute("DROP TABLE clips;")
-            cur.execute(f'CREATE TABLE clips (id serial primary key, routine_id int, show_id int, event_name text, show_name text, start_time float, "text" text not null, url text, embedding vector({EMBEDDING_DIMENSIONS[embedding_model_name]}));')
+    # table, rows and index are written in a single transaction
+    with pooled_connection() as conn:
+        with conn, conn.cursor() as cur:
+            create_clips_table(cur, embedding_model_name)
+            rows = bulk_store(cur, embedded_chunks, batch_size=batch_size)
+            load_time = time.perf_counter() - start
+            logger.info(f"Building {index_method} index on clips.embedding")
+            create_clips_index(cur, index_method)
 
-    for i, chunk in enumerate(embedded_chunks):
-        logger.info(f'Storing chunk {i+1}/{len(embedded_chunks)}')
-        store_pg_results(chunk)
\ No newline at end of file
+    total_time = time.perf_counter() - start
+    logger.info(
+        f"Stored {rows} chunks in {total_time:.1f}s "
+        f"({rows / max(load_time, 1e-9):.0f} rows/s load, {rows / max(total_time, 1e-9):.0f} rows/s including index)"
+    )
+    return rows
@@ -1,17 +1,39 @@
+import argparse
+
 import pandas as pd
 from loguru import logger
+from chilean_humor.build_database import joke_ids
+from chilean_humor.cache import EmbeddingCache
 from chilean_humor.embed import EmbedJokeChunks, JokeChunk
 from chilean_humor.index import set_index
+from chilean_humor.vector_store import VectorStore
 from chilean_humor.config import CONFIG
 
-jokes = pd.read_csv("data/jokes.csv")
 
-chunks = [JokeChunk(**joke) for joke in jokes.to_dict(orient="records")]
+def ingest_jokes(jokes_path: str = "data/jokes.csv", store_path: str = CONFIG["vector_store_path"], postgres: bool = True) -> int:
+    jokes = pd.read_csv(jokes_path)
+    jokes["joke_id"] = joke_ids(jokes)
+    chunks = [JokeChunk(**joke) for joke in jokes.to_dict(orient="records")]
+
+    cache = EmbeddingCache(CONFIG["embedding_cache_path"])
+    embedder = EmbedJokeChunks(CONFIG["embedding_model"], cache=cache)
+    logger.info(f"Embedding {len(chunks)} chunks")
+    embedded_chunks = embedder.embed_batch(chunks)
+    logger.info(f"Embedding cache: {cache.hits} hits, {cache.misses} misses")
+
+    VectorStore.build(embedded_chunks, store_path)
+    if postgres:
+        set_index(embedded_chunks)
+    return len(embedded_chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed data/jokes.csv into the local vector store and the Postgres clips table")
+    parser.add_argument("--jokes", default="data/jokes.csv")
+    parser.add_argument("--no-postgres", action="store_true", help="only build the local vector store")
+    args = parser.parse_args()
+    ingest_jokes(args.jokes, postgres=not args.no_postgres)
 
-embedded_chunks = []
-embedder = EmbedJokeChunks(CONFIG["embedding_model"])
-for i, chunk in enumerate(chunks):
-    logger.info(f"Embedding chunk {i+1}/{len(chunks)}")
-    embedded_chunks.append(embedder(chunk))
 
-set_index(embedded_chunks)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
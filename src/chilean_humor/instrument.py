@@ -0,0 +1,218 @@
+import functools
+import inspect
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from chilean_humor.config import TOKEN_PRICES, WHISPER_PRICE_PER_MINUTE
+from chilean_humor.utils import atomic_write
+
+# pipeline stages and the calls made inside them are both recorded, a stage's time includes its calls
+
+# seconds, from a cached LLM answer to a whole routine through whisper
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# set by whoever works on a routine, calls made inside are attributed to it
+current_routine: ContextVar[Optional[int]] = ContextVar("current_routine", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the quantile, like histogram_quantile without interpolation
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.latency = defaultdict(Histogram)
+            # (stage, routine_id) -> counter name -> value
+            self.counters = defaultdict(lambda: defaultdict(float))
+
+    def observe(self, stage: str, seconds: float, routine_id: Optional[int] = None):
+        routine_id = current_routine.get() if routine_id is None else routine_id
+        with self._lock:
+            self.latency[stage].observe(seconds)
+            counters = self.counters[(stage, routine_id)]
+            counters["calls"] += 1
+            counters["seconds"] += seconds
+
+    def count(self, stage: str, name: str, value: float = 1, routine_id: Optional[int] = None):
+        routine_id = current_routine.get() if routine_id is None else routine_id
+        with self._lock:
+            self.counters[(stage, routine_id)][name] += value
+
+    def usage(self, stage: str, model: str, prompt_tokens: int, completion_tokens: int = 0):
+        input_price, output_price = TOKEN_PRICES.get(model, (0.0, 0.0))
+        self.count(stage, "prompt_tokens", prompt_tokens)
+        self.count(stage, "completion_tokens", completion_tokens)
+        self.count(stage, "cost_usd", (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000)
+
+    def audio(self, stage: str, seconds: float):
+        self.count(stage, "audio_seconds", seconds)
+        self.count(stage, "cost_usd", seconds / 60 * WHISPER_PRICE_PER_MINUTE)
+
+    def report(self) -> Dict:
+        with self._lock:
+            stages = defaultdict(lambda: defaultdict(float))
+            routines = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+            for (stage, routine_id), counters in self.counters.items():
+                for name, value in counters.items():
+                    stages[stage][name] += value
+                    if routine_id is not None:
+                        routines[str(routine_id)][stage][name] += value
+            for stage, histogram in self.latency.items():
+                stages[stage]["p50_seconds"] = histogram.quantile(0.5)
+                stages[stage]["p95_seconds"] = histogram.quantile(0.95)
+                stages[stage]["max_seconds"] = histogram.max
+            return {
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "cost_usd": sum(counters.get("cost_usd", 0.0) for counters in stages.values()),
+                "stages": {stage: dict(counters) for stage, counters in sorted(stages.items())},
+                "routines": {
+                    routine_id: {stage: dict(counters) for stage, counters in sorted(by_stage.items())}
+                    for routine_id, by_stage in sorted(routines.items(), key=lambda item: int(item[0]))
+                },
+            }
+
+    def prometheus(self, prefix: str = "chilean_humor") -> str:
+        # per stage only, routine ids would make one series per routine
+        with self._lock:
+            lines = [
+                f"# HELP {prefix}_stage_seconds Wall time of each call, per stage",
+                f"# TYPE {prefix}_stage_seconds histogram",
+            ]
+            for stage, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            totals = defaultdict(lambda: defaultdict(float))
+            for (stage, _), counters in self.counters.items():
+                for name, value in counters.items():
+                    if name not in ("calls", "seconds"):
+                        totals[name][stage] += value
+            for name, by_stage in sorted(totals.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                for stage, value in sorted(by_stage.items()):
+                    lines.append(f'{prefix}_{name}_total{{stage="{stage}"}} {value}')
+            return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def routine_scope(routine_id: int):
+    token = current_routine.set(routine_id)
+    try:
+        yield
+    finally:
+        current_routine.reset(token)
+
+
+@contextmanager
+def timed(stage: str, routine_id: Optional[int] = None):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.count(stage, "errors", routine_id=routine_id)
+        raise
+    finally:
+        metrics.observe(stage, time.perf_counter() - start, routine_id)
+
+
+def instrumented(stage: str):
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record_usage(stage: str, model: str, response):
+    # instructor keeps the raw completion on the parsed model, fakes and cached answers have none
+    raw = getattr(response, "_raw_response", response)
+    usage = getattr(raw, "usage", None)
+    if usage is not None:
+        metrics.usage(stage, model, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+
+@contextmanager
+def profiled(path: Optional[str], profiler: str = "cprofile"):
+    # profiles the current thread only, run it inside the thread doing the work
+    if path is None:
+        yield
+        return
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with atomic_write(path) as file:
+                file.write(profile.output_html())
+        return
+
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+
+
+def write_report(path: str):
+    with atomic_write(path) as file:
+        json.dump(metrics.report(), file, indent=2)
+
+
+def write_prometheus(path: str):
+    # node_exporter textfile collector format
+    with atomic_write(path) as file:
+        file.write(metrics.prometheus())
@@ -1,12 +1,10 @@
-import instructor
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Optional
 from loguru import logger
 import datetime
-from openai import OpenAI
-
-from dotenv import load_dotenv
-load_dotenv()
+from chilean_humor.cache import LLMCache, get_llm_cache
+from chilean_humor.clients import async_instructor_client, instructor_client
+from chilean_humor.instrument import instrumented, metrics, record_usage
 
 PROMPT = """
 Extract a list of jokes from the transcript in a clear and concise manner that makes use of timestamps, when available, to help others study the jokes from the comedy routine. Respond in the same language as the transcript if it is not english.
@@ -34,78 +32,112 @@ class Repertoire(BaseModel):
     jokes: List[Joke]
 
 
-def create_jokes_from_transcript(txt: str, language: str = "es") -> Repertoire:
+def build_messages(txt: str, language: str = "es") -> List[dict]:
+    return [
+        {
+            "role": "system",
+            "content": f"You are professional comedian writer tasked with extracting a clean list of jokes from a given comedy routine transcript. The jokes must be structured in a clear and precise manner that makes use of timestamps, when available, to help others study the routine. Jokes should be in language code is `{language}`.",
+        },
+        {
+            "role": "user",
+            "content": f"I have added a feature that forces you to response only in `locale={language}` and consider only chilean spanish.",
+        },
+        {
+            "role": "assistant",
+            "content": f"Understood thank you. From now I will only response with `locale={language}`",
+        },
+        {
+            "role": "user",
+            "content": txt,
+        },
+        {"role": "user", "content": PROMPT},
+    ]
+
+SAMPLING_PARAMS = {
+    "temperature": 0,
+    "top_p": 1,
+    "frequency_penalty": 0.6,
+    "presence_penalty": 0.6,
+}
+
+MODELS = ["gpt-4o", "gpt-4-turbo"]
+
+
+def _cached_repertoire(cache: LLMCache, messages: List[dict]) -> Optional[Repertoire]:
+    # an answer from the fallback model is as good as one from the main model
+    return cache.get_any([cache.key(model, messages, Repertoire, SAMPLING_PARAMS) for model in MODELS], Repertoire)
+
+
+@instrumented("create_jokes")
+def create_jokes_from_transcript(txt: str, language: str = "es", cache: Optional[LLMCache] = None) -> Repertoire:
     
-    client = instructor.from_openai(OpenAI())
-
-    try:
-        repertoire = client.chat.completions.create(
-            model="gpt-4o",
-            response_model = Repertoire,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"You are professional comedian writer tasked with extracting a clean list of jokes from a given comedy routine transcript. The jokes must be structured in a clear and precise manner that makes use of timestamps, when available, to help others study the routine. Jokes should be in language code is `{language}`.",
-                },
-                {
-                    "role": "user",
-                    "content": f"I have added a feature that forces you to response only in `locale={language}` and consider only chilean spanish.",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"Understood thank you. From now I will only response with `locale={language}`",
-                },
-                {
-                    "role": "user",
-                    "content": txt,
-                },
-                {"role": "user", "content": PROMPT},
-            ],
-            stream=False,
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0.6,
-            presence_penalty=0.6,
-        )
-    except Exception as e:
-        logger.info(f"Error creating jokes from transcript. {e}")
+    client = instructor_client()
+    cache = cache or get_llm_cache()
+    messages = build_messages(txt, language)
 
+    repertoire = _cached_repertoire(cache, messages)
+    if repertoire is not None:
+        metrics.count("create_jokes", "cache_hits")
+        return repertoire
+
+    for i, model in enumerate(MODELS):
+        if i > 0:
+            logger.info(f"Trying again with {model}.")
+            metrics.count("create_jokes", "fallbacks")
         try:
-            logger.info("Trying again with gpt-4-turbo.")
             repertoire = client.chat.completions.create(
-                model="gpt-4-turbo",
+                model=model,
                 response_model = Repertoire,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": f"You are professional comedian writer tasked with extracting a clean list of jokes from a given comedy routine transcript. The jokes must be structured in a clear and precise manner that makes use of timestamps, when available, to help others study the routine. Jokes should be in language code is `{language}`.",
-                    },
-                    {
-                        "role": "user",
-                        "content": f"I have added a feature that forces you to response only in `locale={language}` and consider only chilean spanish.",
-                    },
-                    {
-                        "role": "assistant",
-                        "content": f"Understood thank you. From now I will only response with `locale={language}`",
-                    },
-                    {
-                        "role": "user",
-                        "content": txt,
-                    },
-                    {"role": "user", "content": PROMPT},
-                ],
+                messages=messages,
                 stream=False,
-                temperature=0,
-                top_p=1,
-                frequency_penalty=0.6,
-                presence_penalty=0.6,
+                **SAMPLING_PARAMS,
             )
+            record_usage("create_jokes", model, repertoire)
+            cache.put(cache.key(model, messages, Repertoire, SAMPLING_PARAMS), repertoire)
+            return repertoire
+        except Exception as e:
+            logger.info(f"Error creating jokes from transcript. {e}")
+            metrics.count("create_jokes", "failures")
+            error = e
+
+    # an empty repertoire would be written and recorded as fresh, the block has to be retried instead
+    raise RuntimeError(f"Every model failed to extract jokes: {error}") from error
+
+
+@instrumented("create_jokes")
+async def acreate_jokes_from_transcript(txt: str, language: str = "es", client=None, cache: Optional[LLMCache] = None) -> Repertoire:
+    # client is any instructor-patched async client, a local fake works too
+    client = client or async_instructor_client()
+    cache = cache or get_llm_cache()
+    messages = build_messages(txt, language)
+
+    repertoire = _cached_repertoire(cache, messages)
+    if repertoire is not None:
+        metrics.count("create_jokes", "cache_hits")
+        return repertoire
 
+    for i, model in enumerate(MODELS):
+        if i > 0:
+            logger.info(f"Trying again with {model}.")
+            metrics.count("create_jokes", "fallbacks")
+        try:
+            repertoire = await client.chat.completions.create(
+                model=model,
+                response_model = Repertoire,
+                messages=messages,
+                stream=False,
+                **SAMPLING_PARAMS,
+            )
+            record_usage("create_jokes", model, repertoire)
+            cache.put(cache.key(model, messages, Repertoire, SAMPLING_PARAMS), repertoire)
+            return repertoire
         except Exception as e:
             logger.info(f"Error creating jokes from transcript. {e}")
-            repertoire = Repertoire(jokes=[])
+            metrics.count("create_jokes", "failures")
+            error = e
 
-    return repertoire
+    # an empty repertoire would be written and recorded as fresh, the block has to be retried instead
+    raise RuntimeError(f"Every model failed to extract jokes: {error}") from error
 
 def fuse_jokes(joke1: Joke, joke2: Joke) -> Joke:
     return Joke(
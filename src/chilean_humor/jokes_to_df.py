@@ -1,38 +1,147 @@
+import argparse
 import glob
 import json
+import os
+import re
+from typing import Dict, List
+
 import pandas as pd
-from chilean_humor.embed import JokeChunk
-from chilean_humor.utils import extract_number, extract_video_id
-
-jokes_files = glob.glob("jokes_refined/*.jsonl")
-
-routines_df = pd.read_csv("data/routines.csv")
-comedians_df = pd.read_csv("data/comedians.csv")
-shows_df = pd.read_csv("data/shows.csv")
-
-jokes_chunks = []
-
-for f in jokes_files:
-    routine_id = extract_number(f)
-    with open(f, "r", encoding="utf-8") as file:
-        for line in file:
-            joke = json.loads(line)
-
-            text = joke["corrected_transcript"]
-            start_timestamp = joke["start_timestamp"]
-            show_id = routines_df[routines_df["ID"] == routine_id]["SHOWID"].values[0]
-            event_name = routines_df[routines_df["ID"] == routine_id]["EVENT"].values[0] + " " + str(routines_df[routines_df["ID"] == routine_id]["YEAR"].values[0])
-            show_name = shows_df[shows_df["ID"] == show_id]["TITLE"].values[0]
-            video_id = extract_video_id(routines_df[routines_df["ID"] == routine_id]["VIDEO"].values[0])
-
-            jokes_chunks.append(JokeChunk(text=text,
-                                            start_timestamp=start_timestamp,
-                                            routine_id=routine_id,
-                                            show_id=show_id,
-                                            event_name=event_name,
-                                            show_name=show_name,
-                                            video_id=video_id).model_dump()
-                                )
-
-df = pd.DataFrame(jokes_chunks)
-df.to_csv("data/jokes.csv", index=False)
\ No newline at end of file
+from loguru import logger
+from chilean_humor.align import NO_ALIGNMENT, TranscriptIndex
+from chilean_humor.utils import extract_number, extract_video_id, file_hash, timestamp_seconds
+
+COLUMNS = ["routine_id", "show_id", "event_name", "show_name", "start_timestamp", "text", "video_id", "aligned_start", "aligned_end", "alignment_confidence"]
+TIMESTAMP_PATTERN = r"^\d{2}:\d{2}:\d{2}$"
+
+
+def transcript_path(routine_id: int, transcripts_folder: str = "transcripts") -> str:
+    return os.path.join(transcripts_folder, f"routine_{routine_id}_transcript.jsonl")
+
+
+def read_refined_jokes(files: List[str], transcripts_folder: str = "transcripts") -> pd.DataFrame:
+    rows = []
+    for f in files:
+        routine_id = extract_number(os.path.basename(f))
+        index = TranscriptIndex.from_file(transcript_path(routine_id, transcripts_folder))
+        with open(f, "r", encoding="utf-8") as file:
+            for line in file:
+                joke = json.loads(line)
+                # the raw transcript is matched, it keeps the wording of the segments
+                alignment = NO_ALIGNMENT
+                if index is not None and re.match(TIMESTAMP_PATTERN, str(joke["start_timestamp"])):
+                    alignment = index.align(joke.get("transcript") or joke["corrected_transcript"], timestamp_seconds(joke["start_timestamp"]))
+                rows.append((routine_id, joke["start_timestamp"], joke["corrected_transcript"], alignment.start_time, alignment.end_time, alignment.confidence))
+    return pd.DataFrame(rows, columns=["routine_id", "start_timestamp", "text", "aligned_start", "aligned_end", "alignment_confidence"])
+
+
+def routine_metadata(routines_df: pd.DataFrame, shows_df: pd.DataFrame) -> pd.DataFrame:
+    # one row per routine, joined once instead of once per joke
+    routines = routines_df[routines_df["VIDEO"].notnull()]
+    metadata = pd.DataFrame({
+        "routine_id": routines["ID"],
+        "show_id": routines["SHOWID"],
+        "event_name": routines["EVENT"] + " " + routines["YEAR"].astype(str),
+        "video_id": routines["VIDEO"].map(extract_video_id),
+    })
+    shows = shows_df.rename(columns={"ID": "show_id", "TITLE": "show_name"})[["show_id", "show_name"]]
+    return metadata.merge(shows, on="show_id", how="left", validate="many_to_one")
+
+
+def join_metadata(jokes: pd.DataFrame, metadata: pd.DataFrame) -> pd.DataFrame:
+    df = jokes.merge(metadata, on="routine_id", how="left", validate="many_to_one", sort=False)
+
+    # bulk validation of what JokeChunk used to check row by row
+    invalid = (
+        df["show_id"].isnull()
+        | df["show_name"].isnull()
+        | df["video_id"].isnull()
+        | df["text"].isnull()
+        | ~df["start_timestamp"].astype(str).str.match(TIMESTAMP_PATTERN)
+    )
+    if invalid.any():
+        logger.warning(f"Dropping {int(invalid.sum())} invalid jokes from routines {sorted(df.loc[invalid, 'routine_id'].unique().tolist())}")
+        df = df[~invalid]
+
+    df = df.astype({"routine_id": int, "show_id": int})
+    return df[COLUMNS]
+
+
+def load_manifest(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_manifest(path: str, manifest: Dict):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+
+def build_jokes_table(
+        jokes_folder: str = "jokes_refined",
+        output_path: str = "data/jokes.csv",
+        manifest_path: str = ".cache/jokes_manifest.json",
+        routines_path: str = "data/routines.csv",
+        shows_path: str = "data/shows.csv",
+        transcripts_folder: str = "transcripts",
+        full: bool = False,
+    ) -> pd.DataFrame:
+    jokes_files = sorted(glob.glob(os.path.join(jokes_folder, "*.jsonl")))
+    # a new transcript changes the alignment of the routine's jokes
+    hashes = {}
+    for f in jokes_files:
+        transcript = transcript_path(extract_number(os.path.basename(f)), transcripts_folder)
+        hashes[os.path.basename(f)] = file_hash(f) + (file_hash(transcript) if os.path.exists(transcript) else "")
+    metadata_hashes = {"routines": file_hash(routines_path), "shows": file_hash(shows_path)}
+
+    manifest = load_manifest(manifest_path)
+    incremental = (
+        not full
+        and os.path.exists(output_path)
+        and manifest.get("metadata") == metadata_hashes
+        and set(COLUMNS) <= set(pd.read_csv(output_path, nrows=0).columns)
+    )
+    previous = manifest.get("files", {}) if incremental else {}
+    changed = [f for f in jokes_files if previous.get(os.path.basename(f)) != hashes[os.path.basename(f)]]
+    removed = set(previous) - set(hashes)
+
+    if incremental and not changed and not removed:
+        logger.info(f"{output_path} is up to date")
+        return pd.read_csv(output_path)
+
+    routines_df = pd.read_csv(routines_path)
+    shows_df = pd.read_csv(shows_path)
+    fresh = join_metadata(read_refined_jokes(changed, transcripts_folder), routine_metadata(routines_df, shows_df))
+
+    if incremental:
+        changed_ids = {extract_number(os.path.basename(f)) for f in changed} | {extract_number(f) for f in removed}
+        kept = pd.read_csv(output_path, dtype={"start_timestamp": str})
+        kept = kept[~kept["routine_id"].isin(changed_ids)]
+        logger.info(f"Rebuilding {len(changed)} routines, keeping {kept['routine_id'].nunique()}")
+        df = pd.concat([kept, fresh], ignore_index=True)
+    else:
+        logger.info(f"Rebuilding all {len(jokes_files)} routines")
+        df = fresh
+
+    # same order as a full rebuild: files sorted by name, jokes in file order
+    order = {extract_number(os.path.basename(f)): i for i, f in enumerate(jokes_files)}
+    df = df.sort_values("routine_id", key=lambda s: s.map(order), kind="stable").reset_index(drop=True)
+
+    df.to_csv(output_path, index=False)
+    save_manifest(manifest_path, {"metadata": metadata_hashes, "files": hashes})
+    logger.info(f"Wrote {len(df)} jokes to {output_path}")
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild data/jokes.csv from jokes_refined/")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and rebuild every routine")
+    args = parser.parse_args()
+    build_jokes_table(full=args.full)
+
+
+if __name__ == "__main__":
+    main()
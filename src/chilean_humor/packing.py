@@ -0,0 +1,114 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Optional
+
+from chilean_humor.config import CONFIG, MAX_CONTEXT_LENGTHS, MAX_OUTPUT_TOKENS
+from chilean_humor.joke import Repertoire, build_messages
+from chilean_humor.segment import Segment
+from chilean_humor.utils import estimate_tokens, timestamp_seconds
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # the encoding files are downloaded on first use, estimate offline
+        return None
+
+
+def count_tokens(text: str, model: str = CONFIG["chat_model"]) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def prompt_overhead(model: str = CONFIG["chat_model"], language: str = "es") -> int:
+    # everything build_messages adds around the transcript, plus ~4 tokens of framing per message
+    messages = build_messages("", language)
+    return sum(count_tokens(m["content"], model) + 4 for m in messages)
+
+
+@dataclass
+class TokenBudget:
+    model: str = CONFIG["chat_model"]
+    context_share: float = 0.5
+    output_share: float = 0.8
+    # the answer repeats every joke twice (raw and corrected transcript)
+    output_ratio: float = 2.0
+    overlap: int = 2
+
+    def input_tokens(self) -> int:
+        max_output = MAX_OUTPUT_TOKENS[self.model]
+        from_context = self.context_share * MAX_CONTEXT_LENGTHS[self.model] - prompt_overhead(self.model) - max_output
+        from_output = self.output_share * max_output / self.output_ratio
+        return max(int(min(from_context, from_output)), 1)
+
+
+@dataclass
+class PromptBlock:
+    text: str
+    tokens: int
+    start_time: float
+    end_time: float
+    # segments at the start of the block repeated from the previous one end here
+    overlap_end_time: Optional[float] = field(default=None)
+
+
+def pack_segments(segments: List[Segment], budget: Optional[TokenBudget] = None) -> List[PromptBlock]:
+    budget = budget or TokenBudget()
+    limit = budget.input_tokens()
+    lines = [(segment, segment.to_prompt()) for segment in segments]
+    lines = [(segment, line, count_tokens(line, budget.model)) for segment, line in lines if line]
+
+    blocks = []
+    current = []
+    tokens = 0
+    overlap_end_time = None
+    for segment, line, line_tokens in lines:
+        if current and tokens + line_tokens > limit:
+            blocks.append(_block(current, tokens, overlap_end_time))
+            # repeat the tail of the block so jokes cut at the boundary are seen whole once
+            tail = current[-budget.overlap:] if budget.overlap and len(current) > budget.overlap else []
+            overlap_end_time = tail[-1][0].end_time if tail else None
+            current = list(tail)
+            tokens = sum(t for _, _, t in current)
+        current.append((segment, line, line_tokens))
+        tokens += line_tokens
+    if current:
+        blocks.append(_block(current, tokens, overlap_end_time))
+    return blocks
+
+
+def _block(lines, tokens, overlap_end_time) -> PromptBlock:
+    return PromptBlock(
+        text="".join(line for _, line, _ in lines),
+        tokens=tokens,
+        start_time=lines[0][0].start_time,
+        end_time=lines[-1][0].end_time,
+        overlap_end_time=overlap_end_time,
+    )
+
+
+def merge_overlapping(blocks: List[PromptBlock], repertoires: List[Repertoire], tolerance: float = 5) -> List[Repertoire]:
+    # jokes told in an overlap region come back from both blocks, keep the earlier block's copy
+    merged = []
+    kept_times = []
+    for block, repertoire in zip(blocks, repertoires):
+        jokes = []
+        for joke in repertoire.jokes:
+            t = timestamp_seconds(joke.start_timestamp)
+            in_overlap = block.overlap_end_time is not None and t <= block.overlap_end_time + tolerance
+            if in_overlap and any(abs(t - kept) <= tolerance for kept in kept_times):
+                continue
+            jokes.append(joke)
+        kept_times.extend(timestamp_seconds(joke.start_timestamp) for joke in jokes)
+        merged.append(Repertoire(jokes=jokes))
+    return merged
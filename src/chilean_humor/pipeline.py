@@ -0,0 +1,326 @@
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from chilean_humor import dedup, joke, refine, topics, vector_store
+from chilean_humor.config import CONFIG, GLOBAL_STAGES, ROUTINE_STAGES
+from chilean_humor.extract_jokes import aextract_routine, repertoire_path
+from chilean_humor.generate_transcripts import fetch_transcript, transcript_path
+from chilean_humor.gate import ContinuityGate
+from chilean_humor.instrument import current_routine, profiled, timed
+from chilean_humor.packing import TokenBudget
+from chilean_humor.ratelimit import RateLimiter
+from chilean_humor.refine_jokes import arefine_routine, refined_path
+from chilean_humor.utils import atomic_write, file_hash
+
+# per routine, each stage reads the output of the one before. Global stages run after every routine is done
+STAGES = ROUTINE_STAGES + GLOBAL_STAGES
+
+DATA_FILES = ["data/routines.csv", "data/shows.csv", "data/comedians.csv"]
+
+FRESH = "fresh"
+ADOPT = "adopt"
+
+
+OUTPUTS = {
+    "transcript": transcript_path,
+    "jokes": repertoire_path,
+    "refined": refined_path,
+    "jokes_table": lambda _: "data/jokes.csv",
+    "database": lambda _: "humor.db",
+    "clusters": lambda _: "humor.db",
+    "vector_index": lambda _: os.path.join(CONFIG["vector_store_path"], "embeddings.npy"),
+    "topics": lambda _: os.path.join(CONFIG["topics_path"], topics.CENTROIDS_FILE),
+}
+
+
+def digest(payload) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def database_jokes_key(db_path: str = "humor.db") -> Optional[str]:
+    # build_database's hash of every routine's jokes, the whole file is no good since clusters and topics write to it
+    if not os.path.exists(db_path):
+        return None
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = '_manifest'").fetchone() is None:
+            return None
+        rows = conn.execute(
+            "SELECT SOURCE, HASH FROM _manifest WHERE SOURCE LIKE 'jokes/%' OR SOURCE = 'build_database' ORDER BY SOURCE"
+        ).fetchall()
+    return digest(rows)
+
+
+@dataclass
+class Step:
+    stage: str
+    routine_id: Optional[int]
+    status: str
+
+
+class Pipeline:
+    def __init__(
+            self,
+            manifest_path: str = CONFIG["pipeline_manifest_path"],
+            budget: Optional[TokenBudget] = None,
+            gate: Optional[ContinuityGate] = None,
+            recheck_chains: bool = False,
+            workers: int = 4,
+            concurrency: int = 8,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            stages: Optional[List[str]] = None,
+            force: Optional[List[str]] = None,
+            client=None,
+            profile_dir: Optional[str] = None,
+            profiler: str = "cprofile",
+        ):
+        self.manifest_path = manifest_path
+        self.budget = budget or TokenBudget()
+        self.gate = gate
+        self.recheck_chains = recheck_chains
+        self.workers = workers
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # the vector index needs Postgres and embeddings, it only runs when asked for
+        self.stages = stages or [stage for stage in STAGES if stage != "vector_index"]
+        self.force = set(force or [])
+        self.client = client
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.manifest = self._load_manifest()
+        self._routines = None
+        self._versions = None
+
+    def _load_manifest(self) -> Dict:
+        if not os.path.exists(self.manifest_path):
+            return {"routines": {}, "global": {}}
+        with open(self.manifest_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def save_manifest(self):
+        with atomic_write(self.manifest_path) as file:
+            json.dump(self.manifest, file, indent=2, sort_keys=True)
+
+    def routines(self) -> Dict[int, str]:
+        if self._routines is None:
+            with open("data/routines.csv", "r", encoding="utf-8", newline="") as file:
+                self._routines = {int(row["ID"]): row["VIDEO"] for row in csv.DictReader(file) if row["VIDEO"]}
+        return self._routines
+
+    def versions(self) -> Dict[str, str]:
+        if self._versions is not None:
+            return self._versions
+        # a change to a prompt, model or stage setting makes the stage stale for every routine
+        self._versions = {
+            "transcript": digest({"max_length": 300}),
+            "jokes": digest({
+                "messages": joke.build_messages("{transcript}"),
+                "models": joke.MODELS,
+                "params": joke.SAMPLING_PARAMS,
+                "budget": asdict(self.budget),
+            }),
+            "refined": digest({
+                "messages": refine.build_messages("{text1}", "{text2}"),
+                "model": refine.MODEL,
+                "gate": vars(self.gate) if self.gate else None,
+                "recheck_chains": self.recheck_chains,
+            }),
+            "jokes_table": digest({}),
+            "database": digest({}),
+            "clusters": digest({"params": dedup.PARAMS, "bands": dedup.BANDS, "threshold": dedup.THRESHOLD}),
+            "vector_index": digest({"model": CONFIG["embedding_model"], "metadata": vector_store.METADATA_FIELDS}),
+            "topics": digest({"keywords": topics.N_KEYWORDS, "min_length": topics.MIN_KEYWORD_LENGTH}),
+        }
+        return self._versions
+
+    def input_key(self, stage: str, routine_id: Optional[int] = None) -> Optional[str]:
+        # None while an input is missing, the stage is blocked until its upstream produces it
+        if stage == "transcript":
+            url = self.routines().get(routine_id)
+            return None if url is None else digest({"inputs": [url], "version": self.versions()[stage]})
+
+        if stage == "jokes":
+            paths = [transcript_path(routine_id)]
+        elif stage == "refined":
+            paths = [repertoire_path(routine_id)]
+        elif stage in ("clusters", "vector_index"):
+            paths = ["data/jokes.csv"]
+        elif stage == "topics":
+            # metadata changes whenever the embedded jokes do, hashing it is cheaper than the matrix
+            paths = ["data/jokes.csv", os.path.join(CONFIG["vector_store_path"], "metadata.jsonl")]
+        else:
+            # whatever routines have produced so far, a routine without output is simply not in the table.
+            # jokes are aligned against the transcripts, so the table depends on both
+            upstream = [refined_path, transcript_path] if stage == "jokes_table" else [transcript_path]
+            paths = [path(routine_id) for routine_id in sorted(self.routines()) for path in upstream]
+            paths = [path for path in paths if os.path.exists(path)] + DATA_FILES
+            if stage == "database":
+                paths.append("data/jokes.csv")
+
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        inputs = [file_hash(path) for path in paths]
+        if stage in ("clusters", "topics"):
+            # rows are keyed by humor.db joke IDs, a rebuilt jokes table makes them stale
+            jokes = database_jokes_key()
+            if jokes is None:
+                return None
+            inputs.append(jokes)
+        return digest({"inputs": inputs, "version": self.versions()[stage]})
+
+    def _entry(self, stage: str, routine_id: Optional[int]) -> Dict:
+        if routine_id is None:
+            return self.manifest["global"].get(stage, {})
+        return self.manifest["routines"].get(str(routine_id), {}).get(stage, {})
+
+    def status(self, stage: str, routine_id: Optional[int] = None, upstream_stale: bool = False) -> str:
+        output = OUTPUTS[stage](routine_id)
+        if upstream_stale:
+            return "upstream changed"
+        key = self.input_key(stage, routine_id)
+        if key is None:
+            return "blocked"
+        if stage in self.force:
+            return "forced"
+        entry = self._entry(stage, routine_id)
+        if not os.path.exists(output):
+            return "missing"
+        if not entry:
+            # outputs from before the manifest existed are trusted as they are
+            return ADOPT
+        return FRESH if entry.get("key") == key else "inputs changed"
+
+    def record(self, stage: str, routine_id: Optional[int] = None):
+        output = OUTPUTS[stage](routine_id)
+        entry = {"key": self.input_key(stage, routine_id), "output": file_hash(output) if os.path.isfile(output) else None}
+        if routine_id is None:
+            self.manifest["global"][stage] = entry
+        else:
+            self.manifest["routines"].setdefault(str(routine_id), {})[stage] = entry
+        self.save_manifest()
+
+    def plan(self, routine_ids: Optional[List[int]] = None) -> List[Step]:
+        steps = []
+        any_stale = False
+        for routine_id in routine_ids or sorted(self.routines()):
+            stale = False
+            for stage in ROUTINE_STAGES:
+                status = self.status(stage, routine_id, upstream_stale=stale)
+                if stage not in self.stages and status not in (FRESH, ADOPT):
+                    steps.append(Step(stage, routine_id, f"skipped, {status}"))
+                    continue
+                stale = stale or status not in (FRESH, ADOPT, "blocked")
+                steps.append(Step(stage, routine_id, status))
+            any_stale = any_stale or stale
+        for stage in GLOBAL_STAGES:
+            if stage not in self.stages:
+                continue
+            status = self.status(stage, upstream_stale=any_stale)
+            any_stale = any_stale or status not in (FRESH, ADOPT)
+            steps.append(Step(stage, None, status))
+        return steps
+
+    def run_local(self, stage: str, func):
+        # cProfile only sees the thread it runs in, so local stages are profiled inside their worker thread
+        path = None
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"{stage}.{'html' if self.profiler == 'pyinstrument' else 'prof'}")
+        with profiled(path, self.profiler):
+            return func()
+
+    async def run_stage(self, stage: str, routine_id: Optional[int], semaphore: asyncio.Semaphore, limiter: RateLimiter):
+        with timed(stage):
+            if stage == "transcript":
+                await asyncio.to_thread(fetch_transcript, routine_id, self.routines()[routine_id])
+            elif stage == "jokes":
+                await aextract_routine(routine_id, semaphore, limiter, self.client, self.budget)
+            elif stage == "refined":
+                await arefine_routine(routine_id, semaphore, self.recheck_chains, self.client, self.gate)
+            elif stage == "jokes_table":
+                from chilean_humor.jokes_to_df import build_jokes_table
+                await asyncio.to_thread(self.run_local, stage, build_jokes_table)
+            elif stage == "database":
+                from chilean_humor.build_database import build_database
+                await asyncio.to_thread(self.run_local, stage, build_database)
+            elif stage == "clusters":
+                await asyncio.to_thread(self.run_local, stage, dedup.build_clusters)
+            elif stage == "vector_index":
+                from chilean_humor.ingest_jokes import ingest_jokes
+                await asyncio.to_thread(self.run_local, stage, ingest_jokes)
+            elif stage == "topics":
+                await asyncio.to_thread(self.run_local, stage, topics.update_topics)
+
+    async def run_routine(self, routine_id: int, workers: asyncio.Semaphore, semaphore: asyncio.Semaphore, limiter: RateLimiter) -> bool:
+        # stages of one routine run in order, a failure stops the routine but not the others
+        async with workers:
+            # gather runs each routine in its own task, the routine set here does not leak into the others
+            current_routine.set(routine_id)
+            stale = False
+            for stage in ROUTINE_STAGES:
+                # once a stage reran, what comes after it can be neither fresh nor adopted
+                status = self.status(stage, routine_id, upstream_stale=stale)
+                if status == FRESH:
+                    continue
+                if status == ADOPT:
+                    self.record(stage, routine_id)
+                    continue
+                if status == "blocked":
+                    return stale
+                if stage not in self.stages:
+                    continue
+                logger.info(f"Routine {routine_id}: running {stage} ({status})")
+                try:
+                    await self.run_stage(stage, routine_id, semaphore, limiter)
+                except Exception as e:
+                    logger.info(f"Routine {routine_id}: {stage} failed {e}")
+                    return stale
+                self.record(stage, routine_id)
+                stale = True
+            return stale
+
+    async def arun(self, routine_ids: Optional[List[int]] = None):
+        workers = asyncio.Semaphore(self.workers)
+        # LLM calls share one semaphore and one rate limiter across every routine
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = RateLimiter(self.requests_per_minute, self.tokens_per_minute)
+        routine_ids = routine_ids or sorted(self.routines())
+        results = await asyncio.gather(*[self.run_routine(routine_id, workers, semaphore, limiter) for routine_id in routine_ids])
+
+        stale = any(results)
+        for stage in GLOBAL_STAGES:
+            if stage not in self.stages:
+                continue
+            status = self.status(stage, upstream_stale=stale)
+            if status == FRESH:
+                continue
+            if status == ADOPT:
+                self.record(stage)
+                continue
+            if status == "blocked":
+                logger.info(f"Skipping {stage}, its inputs are missing")
+                continue
+            logger.info(f"Running {stage} ({status})")
+            await self.run_stage(stage, None, semaphore, limiter)
+            self.record(stage)
+            stale = True
+
+    def run(self, routine_ids: Optional[List[int]] = None):
+        asyncio.run(self.arun(routine_ids))
+
+
+def print_plan(steps: List[Step]):
+    pending = [step for step in steps if step.status != FRESH]
+    for step in pending:
+        target = f"routine {step.routine_id}" if step.routine_id is not None else "all routines"
+        print(f"{step.stage:<13} {target:<14} {step.status}")
+    print(f"{len(pending)} of {len(steps)} steps to run or adopt, {len(steps) - len(pending)} fresh")
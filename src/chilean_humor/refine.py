@@ -1,11 +1,10 @@
-import instructor
 from pydantic import BaseModel, Field
 from enum import Enum
 from loguru import logger
-from openai import OpenAI
-
-from dotenv import load_dotenv
-load_dotenv()
+from typing import List, Optional
+from chilean_humor.cache import LLMCache, get_llm_cache
+from chilean_humor.clients import async_instructor_client, instructor_client
+from chilean_humor.instrument import instrumented, metrics, record_usage
 
 class SequentialOutcome(Enum):
     CONTINUATION = "continuation"
@@ -26,20 +25,66 @@ In your analysis, consider the following:
 * Based on your observations, provide your assessment of whether the second text is a continuation of the first or covers a different theme/topic.
 """
 
-def detect_continuity(text1: str, text2: str) -> SequentialAnalysis:
-    client = instructor.from_openai(OpenAI())
+MODEL = "gpt-4o"
+
+
+def build_messages(text1: str, text2: str) -> List[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"first text: {text1}"},
+        {"role": "user", "content": f"second text: {text2}"},
+    ]
+
+
+@instrumented("detect_continuity")
+def detect_continuity(text1: str, text2: str, cache: Optional[LLMCache] = None) -> SequentialAnalysis:
+    client = instructor_client()
+    cache = cache or get_llm_cache()
+    messages = build_messages(text1, text2)
+    key = cache.key(MODEL, messages, SequentialAnalysis)
+
+    analysis = cache.get(key, SequentialAnalysis)
+    if analysis is not None:
+        metrics.count("detect_continuity", "cache_hits")
+        return analysis
 
     try:
         analysis = client.chat.completions.create(
-            model="gpt-4o",
+            model=MODEL,
+            response_model=SequentialAnalysis,
+            messages=messages,
+        )
+        record_usage("detect_continuity", MODEL, analysis)
+        cache.put(key, analysis)
+        return analysis
+    except Exception as e:
+        logger.error(f"Error analyzing continuity: {e}")
+        metrics.count("detect_continuity", "failures")
+        return SequentialAnalysis(reasoning="", outcome=SequentialOutcome.NOT_CONTINUATION)
+
+
+@instrumented("detect_continuity")
+async def adetect_continuity(text1: str, text2: str, client=None, cache: Optional[LLMCache] = None) -> SequentialAnalysis:
+    client = client or async_instructor_client()
+    cache = cache or get_llm_cache()
+    messages = build_messages(text1, text2)
+    key = cache.key(MODEL, messages, SequentialAnalysis)
+
+    analysis = cache.get(key, SequentialAnalysis)
+    if analysis is not None:
+        metrics.count("detect_continuity", "cache_hits")
+        return analysis
+
+    try:
+        analysis = await client.chat.completions.create(
+            model=MODEL,
             response_model=SequentialAnalysis,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"first text: {text1}"},
-                {"role": "user", "content": f"second text: {text2}"},
-            ],
+            messages=messages,
         )
+        record_usage("detect_continuity", MODEL, analysis)
+        cache.put(key, analysis)
         return analysis
     except Exception as e:
-        logger.error(f"Error analyzing continuity: {e}")       
-        return SequentialAnalysis(outcome=SequentialOutcome.DIFERRENT_TOPIC)
\ No newline at end of file
+        logger.error(f"Error analyzing continuity: {e}")
+        metrics.count("detect_continuity", "failures")
+        return SequentialAnalysis(reasoning="", outcome=SequentialOutcome.NOT_CONTINUATION)
@@ -1,48 +1,158 @@
 from loguru import logger
-import json
+import argparse
+import asyncio
+import os
+from typing import List, Optional
 
-from chilean_humor.utils import extract_routines_ids
+from chilean_humor.utils import atomic_write, extract_routines_ids, read_jokes
+from chilean_humor.extract_jokes import repertoire_path
+from chilean_humor.gate import ContinuityGate
+from chilean_humor.instrument import routine_scope
 from chilean_humor.joke import Joke, fuse_jokes
-from chilean_humor.refine import detect_continuity
+from chilean_humor.refine import SequentialOutcome, adetect_continuity, detect_continuity
 
 
+def refined_path(routine_id: int) -> str:
+    return f"jokes_refined/routine_{routine_id}_refined_repertoire.jsonl"
+
+def write_refined_jokes(routine_id: int, jokes: List[Joke]):
+    logger.info(f"Writing refined jokes for routine {routine_id}.")
+    with atomic_write(refined_path(routine_id)) as file:
+        for joke in jokes:
+            file.write(joke.json() + "\n")
+
+def refine_sequential(jokes: List[Joke], gate: Optional[ContinuityGate] = None) -> List[Joke]:
+    refined = []
+    fitted = gate.fit([joke.corrected_transcript for joke in jokes]) if gate else None
+    saved = 0
+    for joke in jokes:
+        if len(refined) == 0:
+            refined.append(joke)
+            continue
+
+        previous_joke = refined[-1]
+        is_continuation = fitted.decide(previous_joke, joke) if fitted else None
+        if is_continuation is None:
+            analysis = detect_continuity(previous_joke.corrected_transcript, joke.corrected_transcript)
+            is_continuation = analysis.outcome.value == "continuation"
+        else:
+            saved += 1
+
+        if is_continuation:
+            logger.info("Fusing jokes.")
+            refined[-1] = fuse_jokes(previous_joke, joke)
+        else:
+            logger.info("Adding new joke.")
+            refined.append(joke)
+    if fitted:
+        logger.info(f"Gate saved {saved}/{max(len(jokes) - 1, 0)} LLM calls.")
+    return refined
+
+async def arefine(
+        jokes: List[Joke],
+        semaphore: asyncio.Semaphore,
+        recheck_chains: bool = False,
+        client=None,
+        gate: Optional[ContinuityGate] = None,
+        routine_id: Optional[int] = None,
+    ) -> List[Joke]:
+
+    async def continuity(text1, text2):
+        async with semaphore:
+            analysis = await adetect_continuity(text1, text2, client=client)
+            return analysis.outcome == SequentialOutcome.CONTINUATION
+
+    pairs = list(zip(jokes, jokes[1:]))
+    decisions = [None] * len(pairs)
+    if gate is not None:
+        fitted = gate.fit([joke.corrected_transcript for joke in jokes])
+        decisions = [fitted.decide(a, b) for a, b in pairs]
+        saved = sum(decision is not None for decision in decisions)
+        logger.info(f"Routine {routine_id}: gate saved {saved}/{len(pairs)} LLM calls.")
+
+    async def outcome(pair, decision):
+        if decision is not None:
+            return decision
+        return await continuity(pair[0].corrected_transcript, pair[1].corrected_transcript)
+
+    # every adjacent pair is scored at once, fusing is a single ordered fold afterwards
+    outcomes = await asyncio.gather(*[outcome(pair, decision) for pair, decision in zip(pairs, decisions)])
+
+    refined = jokes[:1]
+    chain = False
+    for joke, is_continuation in zip(jokes[1:], outcomes):
+        if is_continuation and chain and recheck_chains:
+            # a chain of continuations formed, check the joke against the whole fused text
+            is_continuation = await continuity(refined[-1].corrected_transcript, joke.corrected_transcript)
+
+        if is_continuation:
+            refined[-1] = fuse_jokes(refined[-1], joke)
+        else:
+            refined.append(joke)
+        chain = is_continuation
+    return refined
+
+async def arefine_routine(
+        routine_id: int,
+        semaphore: asyncio.Semaphore,
+        recheck_chains: bool = False,
+        client=None,
+        gate: Optional[ContinuityGate] = None,
+    ):
+    logger.info(f"Refining jokes for routine {routine_id}.")
+    jokes = read_jokes(repertoire_path(routine_id))
+    refined = await arefine(jokes, semaphore, recheck_chains=recheck_chains, client=client, gate=gate, routine_id=routine_id)
+    logger.info(f"Routine {routine_id}: {len(jokes)} jokes refined into {len(refined)}.")
+    write_refined_jokes(routine_id, refined)
+
+async def arefine_routines(
+        routine_ids: List[int],
+        concurrency: int = 8,
+        recheck_chains: bool = False,
+        client=None,
+        gate: Optional[ContinuityGate] = None,
+    ):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def refine(routine_id):
+        with routine_scope(routine_id):
+            await arefine_routine(routine_id, semaphore, recheck_chains, client, gate)
+
+    results = await asyncio.gather(*[refine(routine_id) for routine_id in routine_ids], return_exceptions=True)
+    for routine_id, result in zip(routine_ids, results):
+        if isinstance(result, Exception):
+            logger.info(f"Error refining jokes for {routine_id} {result}")
+
 def main():
-    routine_ids = extract_routines_ids(folder='jokes')
+    parser = argparse.ArgumentParser(description="Fuse consecutive jokes that continue the same topic")
+    parser.add_argument("routine_ids", type=int, nargs="*", help="defaults to every routine without refined jokes")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--recheck-chains", action="store_true", help="re-check the fused text when continuations chain")
+    parser.add_argument("--sequential", action="store_true", help="one pair at a time against the fused previous joke")
+    parser.add_argument("--no-gate", action="store_true", help="send every pair to the LLM")
+    parser.add_argument("--low-similarity", type=float, default=0.05)
+    parser.add_argument("--high-similarity", type=float, default=None)
+    parser.add_argument("--min-gap", type=float, default=60.0, help="seconds between joke starts")
+    args = parser.parse_args()
+
+    routine_ids = args.routine_ids or [
+        routine_id for routine_id in sorted(extract_routines_ids(folder='jokes'))
+        if not os.path.exists(refined_path(routine_id))
+    ]
+
+    gate = None if args.no_gate else ContinuityGate(args.low_similarity, args.high_similarity, args.min_gap)
+
+    if not args.sequential:
+        asyncio.run(arefine_routines(routine_ids, args.concurrency, args.recheck_chains, gate=gate))
+        return
 
     for routine_id in routine_ids:
-        filename = f"jokes/routine_{routine_id}_repertoire.jsonl"
-        jokes = []
         logger.info(f"Refining jokes for routine {routine_id}.")
-        with open(filename, "r", encoding="utf-8") as file:
-            for line in file:
-                dict_line = json.loads(line)
-
-                if len(jokes) == 0:
-                    jokes.append(Joke(**dict_line))
-                    continue
-
-                else:
-                    joke = Joke(**dict_line)
-                    previous_joke = jokes[-1]
-                    
-                    analysis = detect_continuity(previous_joke.corrected_transcript, joke.corrected_transcript)
-                    if analysis.outcome.value == "continuation":
-                        logger.info("Fusing jokes.")
-                        fused_joke = fuse_jokes(previous_joke, joke)
-                        jokes[-1] = fused_joke
-                    else:
-                        logger.info("Adding new joke.")
-                        jokes.append(joke)
-
-        logger.info(f"Writing refined jokes for routine {routine_id}.")               
-        for joke in jokes:
-            try:
-                with open(f"jokes_refined/routine_{routine_id}_refined_repertoire.jsonl", "a", encoding="utf-8") as file:
-                    json_line = joke.json()
-                    file.write(json_line + "\n")
-            except Exception as e:
-                logger.info(f"Error writing joke for {routine_id} {e}")
-                continue
+        try:
+            write_refined_jokes(routine_id, refine_sequential(read_jokes(repertoire_path(routine_id)), gate=gate))
+        except Exception as e:
+            logger.info(f"Error writing joke for {routine_id} {e}")
+            continue
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import re
+import unicodedata
+from collections import Counter
+from typing import TYPE_CHECKING, Iterable, List, Optional, Union
+
+import numpy as np
+from loguru import logger
+
+from chilean_humor.config import CONFIG
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+TOKEN_PATTERN = re.compile(r"[0-9a-zñ]+")
+# strip every combining mark except the tilde of ñ
+ACCENT_PATTERN = re.compile(r"(?<!n)\u0303|[\u0300-\u0302\u0304-\u036f]")
+
+Filter = Optional[Union[int, Iterable[int]]]
+
+
+def fold_accents(text: str) -> str:
+    text = unicodedata.normalize("NFD", text.lower())
+    return unicodedata.normalize("NFC", ACCENT_PATTERN.sub("", text))
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(fold_accents(text))
+
+
+def extract_years(event_names: "pd.Series") -> "pd.Series":
+    return event_names.str.extract(r"(\d{4})\s*$")[0].fillna(0).astype(int)
+
+
+def _as_array(values: Filter) -> Optional[np.ndarray]:
+    if values is None:
+        return None
+    if isinstance(values, (int, np.integer)):
+        return np.array([values])
+    values = list(values)
+    # an empty selection (every checkbox cleared) means no filter, not no results
+    return np.asarray(values) if values else None
+
+
+class BM25Index:
+    def __init__(self, terms, indptr, doc_ids, weights, doc_lengths, routine_ids, show_ids, years, text_bytes, text_offsets):
+        self.terms = terms
+        self.vocabulary = {term: i for i, term in enumerate(terms.tolist())}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.doc_lengths = doc_lengths
+        self.routine_ids = routine_ids
+        self.show_ids = show_ids
+        self.years = years
+        self.text_bytes = text_bytes
+        self.text_offsets = text_offsets
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts: List[str], routine_ids=None, show_ids=None, years=None, k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        n_docs = len(texts)
+        vocabulary = {}
+        posting_terms, posting_docs, posting_tfs = [], [], []
+        doc_lengths = np.zeros(n_docs, dtype=np.int32)
+
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                posting_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                posting_docs.append(doc_id)
+                posting_tfs.append(tf)
+
+        posting_terms = np.asarray(posting_terms, dtype=np.int32)
+        posting_docs = np.asarray(posting_docs, dtype=np.int32)
+        posting_tfs = np.asarray(posting_tfs, dtype=np.float32)
+
+        # postings sorted by term, CSR style: term i owns doc_ids[indptr[i]:indptr[i + 1]]
+        order = np.lexsort((posting_docs, posting_terms))
+        posting_terms, posting_docs, posting_tfs = posting_terms[order], posting_docs[order], posting_tfs[order]
+        document_frequency = np.bincount(posting_terms, minlength=len(vocabulary))
+        indptr = np.concatenate([[0], np.cumsum(document_frequency)]).astype(np.int64)
+
+        # BM25 term weights do not depend on the query, so they are stored per posting
+        idf = np.log1p((n_docs - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        avgdl = max(doc_lengths.mean(), 1.0) if n_docs else 1.0
+        norm = k1 * (1 - b + b * doc_lengths[posting_docs] / avgdl)
+        weights = (idf[posting_terms] * posting_tfs * (k1 + 1) / (posting_tfs + norm)).astype(np.float32)
+
+        encoded = [text.encode("utf-8") for text in texts]
+        text_offsets = np.concatenate([[0], np.cumsum([len(t) for t in encoded])]).astype(np.int64)
+        text_bytes = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+        terms = np.array(sorted(vocabulary, key=vocabulary.get), dtype=str)
+        return cls(
+            terms=terms,
+            indptr=indptr,
+            doc_ids=posting_docs,
+            weights=weights,
+            doc_lengths=doc_lengths,
+            routine_ids=np.asarray(routine_ids if routine_ids is not None else np.zeros(n_docs), dtype=np.int32),
+            show_ids=np.asarray(show_ids if show_ids is not None else np.zeros(n_docs), dtype=np.int32),
+            years=np.asarray(years if years is not None else np.zeros(n_docs), dtype=np.int32),
+            text_bytes=text_bytes,
+            text_offsets=text_offsets,
+        )
+
+    @classmethod
+    def from_jokes(cls, jokes_df: "pd.DataFrame", **kwargs) -> "BM25Index":
+        return cls.build(
+            jokes_df["text"].astype(str).tolist(),
+            routine_ids=jokes_df["routine_id"].to_numpy(),
+            show_ids=jokes_df["show_id"].to_numpy(),
+            years=extract_years(jokes_df["event_name"]).to_numpy(),
+            **kwargs,
+        )
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            terms=self.terms,
+            indptr=self.indptr,
+            doc_ids=self.doc_ids,
+            weights=self.weights,
+            doc_lengths=self.doc_lengths,
+            routine_ids=self.routine_ids,
+            show_ids=self.show_ids,
+            years=self.years,
+            text_bytes=self.text_bytes,
+            text_offsets=self.text_offsets,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def text(self, doc_id: int) -> str:
+        start, end = self.text_offsets[doc_id], self.text_offsets[doc_id + 1]
+        return self.text_bytes[start:end].tobytes().decode("utf-8")
+
+    def scores(self, query: str):
+        term_ids = [self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary]
+        if not term_ids:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        # only the postings of the query terms are touched
+        slices = [slice(self.indptr[t], self.indptr[t + 1]) for t in term_ids]
+        docs = np.concatenate([self.doc_ids[s] for s in slices])
+        weights = np.concatenate([self.weights[s] for s in slices])
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        return candidates, np.bincount(inverse, weights=weights).astype(np.float32)
+
+    def search(self, query: str, k: int = 10, show_id: Filter = None, routine_id: Filter = None, year: Filter = None) -> List[dict]:
+        candidates, scores = self.scores(query)
+
+        mask = np.ones(len(candidates), dtype=bool)
+        for values, column in ((show_id, self.show_ids), (routine_id, self.routine_ids), (year, self.years)):
+            values = _as_array(values)
+            if values is not None:
+                mask &= np.isin(column[candidates], values)
+        candidates, scores = candidates[mask], scores[mask]
+
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+
+        return [
+            {
+                "index": int(doc_id),
+                "score": float(score),
+                "routine_id": int(self.routine_ids[doc_id]),
+                "show_id": int(self.show_ids[doc_id]),
+                "year": int(self.years[doc_id]),
+                "text": self.text(doc_id),
+            }
+            for doc_id, score in zip(candidates[top], scores[top])
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BM25 keyword search over data/jokes.csv")
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--build", action="store_true", help="rebuild the index from data/jokes.csv")
+    parser.add_argument("--index", default=CONFIG["search_index_path"])
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--show-id", type=int, nargs="*")
+    parser.add_argument("--routine-id", type=int, nargs="*")
+    parser.add_argument("--year", type=int, nargs="*")
+    args = parser.parse_args()
+
+    if args.build:
+        import pandas as pd
+        index = BM25Index.from_jokes(pd.read_csv("data/jokes.csv"))
+        index.save(args.index)
+        logger.info(f"Indexed {len(index)} jokes with {len(index.terms)} terms in {args.index}")
+    else:
+        index = BM25Index.load(args.index)
+
+    if args.query:
+        for result in index.search(args.query, k=args.k, show_id=args.show_id, routine_id=args.routine_id, year=args.year):
+            print(f"{result['score']:6.2f}  {result['year']}  routine {result['routine_id']}: {result['text']}")
+
+
+if __name__ == "__main__":
+    main()
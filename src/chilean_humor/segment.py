@@ -2,11 +2,15 @@
 
 from dataclasses import dataclass, field, asdict
 from datetime import timedelta
-from typing import List
+from typing import Iterable, Iterator, List, Optional
+import asyncio
+import itertools
 import json
+import re
 
 from loguru import logger
-from chilean_humor.joke import create_jokes_from_transcript
+from chilean_humor.ratelimit import RateLimiter
+from chilean_humor.utils import estimate_tokens
 
 @dataclass
 class Segment:
@@ -62,60 +66,79 @@ class Segment:
             transcript=dict_line["transcript"],
         )
 
-def group_speech_segments(
-    segments: List[Segment], max_length=300
-):
-    phrases = []
-    current_segment = segments[0]
-    current_transcript = current_segment.transcript
+DEFAULT_MARKERS = ("[Música]", "[Aplausos]")
+
+def compile_markers(markers=DEFAULT_MARKERS):
+    # applied one after the other, like the chained str.replace calls they replace
+    patterns = [re.compile(re.escape(marker)) for marker in markers]
+
+    def strip_markers(text: str) -> str:
+        for pattern in patterns:
+            text = pattern.sub("", text)
+        return text
+
+    return strip_markers
+
+_strip_default_markers = compile_markers()
+
+def iter_group_speech_segments(
+    segments: Iterable[Segment], max_length=300, markers=None
+) -> Iterator[Segment]:
+    # streaming version of group_speech_segments, input segments are never modified
+    strip_markers = compile_markers(markers) if markers is not None else _strip_default_markers
+    segments = iter(segments)
+    current_segment = next(segments, None)
+    if current_segment is None:
+        return
+
+    # the first phrase starts from the unstripped text of the first segment, as it always has
+    parts = [current_segment.transcript]
+    length = len(current_segment.transcript)
     current_start_time = current_segment.start_time
     from_whisper = current_segment.from_whisper
 
-    current_segment.transcript = current_segment.transcript.replace("[Música]", "")
-    current_segment.transcript = current_segment.transcript.replace("[Aplausos]", "")
-
-    for segment in segments:
+    previous_segment = current_segment
+    for segment in itertools.chain([current_segment], segments):
         previous_segment = current_segment
         current_segment = segment
-
-        current_segment.transcript = current_segment.transcript.replace("[Música]", "")
-        current_segment.transcript = current_segment.transcript.replace("[Aplausos]", "")
+        text = strip_markers(current_segment.transcript)
 
         is_pause = (current_segment.start_time - previous_segment.end_time) > 0.1
         is_long = current_segment.start_time - current_start_time > 1
-        is_too_long = len(current_transcript) > max_length
+        is_too_long = length > max_length
 
         if (is_long and is_pause) or is_too_long:
-            phrases.append(
-                Segment(
-                    language=current_segment.language,
-                    start_time=current_start_time,
-                    end_time=previous_segment.end_time,
-                    transcript=current_transcript.strip(),
-                    from_whisper=from_whisper,
-                )
+            yield Segment(
+                language=current_segment.language,
+                start_time=current_start_time,
+                end_time=previous_segment.end_time,
+                transcript=" ".join(parts).strip(),
+                from_whisper=from_whisper,
             )
-            current_transcript = current_segment.transcript
+            parts = [text]
+            length = len(text)
             current_start_time = current_segment.start_time
         else:
-            current_transcript += " " + current_segment.transcript
-
-    phrases.append(
-                Segment(
-                    language=current_segment.language,
-                    start_time=current_start_time,
-                    end_time=previous_segment.end_time,
-                    transcript=current_transcript.strip(),
-                    from_whisper=from_whisper,
-                )
-            )
-    
-    return phrases
+            parts.append(text)
+            length += 1 + len(text)
 
-def extract_jokes_from_segments(
+    yield Segment(
+        language=current_segment.language,
+        start_time=current_start_time,
+        end_time=previous_segment.end_time,
+        transcript=" ".join(parts).strip(),
+        from_whisper=from_whisper,
+    )
+
+def group_speech_segments(
+    segments: List[Segment], max_length=300, markers=None
+):
+    return list(iter_group_speech_segments(segments, max_length=max_length, markers=markers))
+
+def split_prompt_blocks(
         segments, chunk=300 * 10
 ):
-    repertoires = []
+    blocks = []
     text = ""
 
     for block in segments:
@@ -123,16 +146,61 @@ def extract_jokes_from_segments(
         if len(text) < chunk:
            text += f"\n{block.to_prompt()}"
         else:
-            logger.info("Extracting jokes.")
-            repertoire = create_jokes_from_transcript(text)
-            repertoires.append(repertoire)
+            blocks.append(text)
             text = f"{block.to_prompt()}"
-            logger.info(f"Extracted {len(repertoire.jokes)} jokes.")
-        
+
     if text is not None and text != "":
+        blocks.append(text)
+
+    return blocks
+
+def extract_jokes_from_blocks(texts: List[str]):
+    # joke is only needed once blocks are sent to the LLM, grouping segments stays free of it
+    from chilean_humor.joke import create_jokes_from_transcript
+    repertoires = []
+
+    for text in texts:
         logger.info("Extracting jokes.")
         repertoire = create_jokes_from_transcript(text)
         repertoires.append(repertoire)
         logger.info(f"Extracted {len(repertoire.jokes)} jokes.")
 
-    return repertoires    
\ No newline at end of file
+    return repertoires
+
+def extract_jokes_from_segments(
+        segments, chunk=300 * 10
+):
+    return extract_jokes_from_blocks(split_prompt_blocks(segments, chunk=chunk))
+
+async def aextract_jokes_from_blocks(
+        texts: List[str],
+        semaphore: Optional[asyncio.Semaphore] = None,
+        limiter: Optional[RateLimiter] = None,
+        client=None,
+        output_ratio: Optional[float] = None,
+):
+    from chilean_humor.joke import acreate_jokes_from_transcript
+    from chilean_humor.packing import TokenBudget
+    # blocks run concurrently, repertoires come back in block order
+    semaphore = semaphore or asyncio.Semaphore(8)
+    output_ratio = TokenBudget.output_ratio if output_ratio is None else output_ratio
+
+    async def extract(text):
+        async with semaphore:
+            if limiter:
+                await limiter.acquire(int(estimate_tokens(text) * (1 + output_ratio)))
+            logger.info("Extracting jokes.")
+            repertoire = await acreate_jokes_from_transcript(text, client=client)
+            logger.info(f"Extracted {len(repertoire.jokes)} jokes.")
+            return repertoire
+
+    return await asyncio.gather(*[extract(text) for text in texts])
+
+async def aextract_jokes_from_segments(
+        segments,
+        chunk=300 * 10,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        limiter: Optional[RateLimiter] = None,
+        client=None,
+):
+    return await aextract_jokes_from_blocks(split_prompt_blocks(segments, chunk=chunk), semaphore, limiter, client)
@@ -0,0 +1,210 @@
+import argparse
+import json
+import math
+import os
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from chilean_humor.config import CONFIG
+from chilean_humor.search import tokenize
+from chilean_humor.utils import atomic_write
+from chilean_humor.vector_store import BLOCK_SIZE, VectorStore, _normalize
+
+if TYPE_CHECKING:
+    import sqlite_utils
+
+CENTROIDS_FILE = "centroids.npy"
+COUNTS_FILE = "counts.npy"
+TOPICS_FILE = "topics.json"
+
+N_CLUSTERS = 40
+BATCH_SIZE = 1024
+EPOCHS = 5
+N_KEYWORDS = 8
+# short words are mostly articles and pronouns, they never describe a topic
+MIN_KEYWORD_LENGTH = 4
+
+
+class MiniBatchKMeans:
+    # spherical k-means on unit vectors, one batch in memory at a time (Sculley, web-scale k-means clustering)
+    def __init__(self, n_clusters: int = N_CLUSTERS, batch_size: int = BATCH_SIZE, seed: int = 0,
+                 centroids: Optional[np.ndarray] = None, counts: Optional[np.ndarray] = None):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.centroids = centroids
+        self.counts = counts
+
+    def init_centroids(self, sample: np.ndarray):
+        # k-means++ seeding on a sample, distances are 1 - cosine similarity
+        k = min(self.n_clusters, len(sample))
+        centroids = [sample[self.rng.integers(len(sample))]]
+        distances = 1 - sample @ centroids[0]
+        for _ in range(1, k):
+            weights = np.maximum(distances, 0)
+            p = weights / weights.sum() if weights.sum() > 0 else None
+            centroids.append(sample[self.rng.choice(len(sample), p=p)])
+            distances = np.minimum(distances, 1 - sample @ centroids[-1])
+        self.centroids = np.stack(centroids).astype(np.float32)
+        self.counts = np.zeros(k, dtype=np.int64)
+
+    def partial_fit(self, batch: np.ndarray) -> float:
+        # each centroid moves toward the mean of its batch members with a step of 1 / points seen so far
+        labels = (batch @ self.centroids.T).argmax(axis=1)
+        sizes = np.bincount(labels, minlength=len(self.centroids))
+        sums = np.eye(len(self.centroids), dtype=np.float32)[labels].T @ batch
+        updated = sizes > 0
+        self.counts += sizes
+        rate = (sizes[updated] / self.counts[updated])[:, None].astype(np.float32)
+        previous = self.centroids[updated]
+        self.centroids[updated] = _normalize(previous + rate * (sums[updated] / sizes[updated, None] - previous))
+        return float(np.abs(self.centroids[updated] - previous).max())
+
+    def fit(self, embeddings: np.ndarray, epochs: int = EPOCHS, tol: float = 1e-4) -> "MiniBatchKMeans":
+        # embeddings can be a memory map, only the sampled rows and the current batch are read
+        n = len(embeddings)
+        if self.centroids is None:
+            sample = np.sort(self.rng.choice(n, min(n, max(self.batch_size, 10 * self.n_clusters)), replace=False))
+            self.init_centroids(_normalize(np.asarray(embeddings[sample], dtype=np.float32)))
+        starts = np.arange(0, n, self.batch_size)
+        for epoch in range(epochs):
+            shift = 0.0
+            for start in self.rng.permutation(starts):
+                batch = _normalize(np.asarray(embeddings[start:start + self.batch_size], dtype=np.float32))
+                shift = max(shift, self.partial_fit(batch))
+            logger.info(f"Epoch {epoch + 1}/{epochs}, largest centroid shift {shift:.5f}")
+            if shift < tol:
+                break
+        return self
+
+    def predict(self, embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        labels = np.empty(len(embeddings), dtype=np.int64)
+        scores = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), BLOCK_SIZE):
+            similarity = _normalize(np.asarray(embeddings[start:start + BLOCK_SIZE], dtype=np.float32)) @ self.centroids.T
+            labels[start:start + len(similarity)] = similarity.argmax(axis=1)
+            scores[start:start + len(similarity)] = similarity.max(axis=1)
+        return labels, scores
+
+    def save(self, path: str, metadata: Dict):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(path, COUNTS_FILE), self.counts)
+        with atomic_write(os.path.join(path, TOPICS_FILE)) as file:
+            json.dump({"n_clusters": len(self.centroids), "batch_size": self.batch_size, **metadata}, file, indent=2, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["MiniBatchKMeans"]:
+        if not os.path.exists(os.path.join(path, CENTROIDS_FILE)):
+            return None
+        with open(os.path.join(path, TOPICS_FILE), "r", encoding="utf-8") as file:
+            metadata = json.load(file)
+        return cls(
+            metadata["n_clusters"],
+            metadata["batch_size"],
+            centroids=np.load(os.path.join(path, CENTROIDS_FILE)),
+            counts=np.load(os.path.join(path, COUNTS_FILE)),
+        )
+
+
+def topic_keywords(texts: List[str], labels: np.ndarray, n_clusters: int, n_keywords: int = N_KEYWORDS) -> List[List[str]]:
+    # class-based tf-idf: frequent in the topic, rare across topics
+    counts = [Counter() for _ in range(n_clusters)]
+    for text, label in zip(texts, labels):
+        counts[label].update(token for token in tokenize(text) if len(token) >= MIN_KEYWORD_LENGTH)
+    totals = Counter()
+    for topic in counts:
+        totals.update(topic)
+    average = sum(totals.values()) / max(n_clusters, 1)
+
+    keywords = []
+    for topic in counts:
+        size = sum(topic.values()) or 1
+        scores = {term: count / size * math.log(1 + average / totals[term]) for term, count in topic.items()}
+        keywords.append([term for term, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:n_keywords]])
+    return keywords
+
+
+def joke_ids(db: "sqlite_utils.Database", metadata: List[dict]) -> List[Optional[int]]:
+    # the vector store keeps each joke's humor.db ID, a joke told twice in a routine has the same text but not the same ID
+    known = {joke_id for (joke_id,) in db.execute('SELECT "ID" FROM "jokes"')}
+    return [row.get("joke_id") if row.get("joke_id") in known else None for row in metadata]
+
+
+def write_topics(db_path: str, store: VectorStore, labels: np.ndarray, scores: np.ndarray, keywords: List[List[str]]) -> int:
+    import sqlite_utils
+    db = sqlite_utils.Database(db_path)
+    ids = joke_ids(db, store.metadata)
+    rows = [
+        {"JOKEID": joke_id, "TOPICID": int(label), "SCORE": round(float(score), 4)}
+        for joke_id, label, score in zip(ids, labels, scores)
+        if joke_id is not None
+    ]
+    if len(rows) < len(ids):
+        logger.warning(f"{len(ids) - len(rows)} embedded jokes are not in {db_path}, the vector store is older than the database")
+    sizes = Counter(row["TOPICID"] for row in rows)
+
+    with db.conn:
+        for table in ("joke_topics", "topics"):
+            if table in db.table_names():
+                db[table].drop()
+        db["topics"].insert_all(
+            [{"ID": i, "KEYWORDS": ", ".join(words), "SIZE": sizes.get(i, 0)} for i, words in enumerate(keywords)],
+            pk="ID",
+        )
+        db["joke_topics"].create(
+            {"JOKEID": int, "TOPICID": int, "SCORE": float},
+            pk="JOKEID",
+            foreign_keys=[("JOKEID", "jokes", "ID"), ("TOPICID", "topics", "ID")],
+        )
+        db["joke_topics"].insert_all(rows)
+    db["joke_topics"].create_index(["TOPICID"], if_not_exists=True)
+    return len(rows)
+
+
+def update_topics(
+        db_path: str = "humor.db",
+        store_path: str = CONFIG["vector_store_path"],
+        topics_path: str = CONFIG["topics_path"],
+        n_clusters: int = N_CLUSTERS,
+        batch_size: int = BATCH_SIZE,
+        epochs: int = EPOCHS,
+        refit: bool = False,
+    ) -> int:
+    store = VectorStore.load(store_path)
+    model = None if refit else MiniBatchKMeans.load(topics_path)
+    if model is not None and model.centroids.shape[1] != store.embeddings.shape[1]:
+        logger.info("Embedding size changed, fitting new topics")
+        model = None
+
+    if model is None:
+        logger.info(f"Fitting {n_clusters} topics on {len(store)} jokes in batches of {batch_size}")
+        model = MiniBatchKMeans(n_clusters, batch_size).fit(store.embeddings, epochs)
+    else:
+        # saved centroids stay fixed, new routines are only assigned to them
+        logger.info(f"Assigning {len(store)} jokes to {len(model.centroids)} saved topics")
+
+    labels, scores = model.predict(store.embeddings)
+    keywords = topic_keywords([row["text"] for row in store.metadata], labels, len(model.centroids))
+    model.save(topics_path, {"embedding_model": CONFIG["embedding_model"], "keywords": keywords})
+    rows = write_topics(db_path, store, labels, scores, keywords)
+    logger.info(f"Wrote topics for {rows} jokes to {db_path}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Group joke embeddings into topics with mini-batch k-means")
+    parser.add_argument("--db", default="humor.db")
+    parser.add_argument("--clusters", type=int, default=N_CLUSTERS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--refit", action="store_true", help="fit new centroids instead of assigning to the saved ones")
+    args = parser.parse_args()
+    update_topics(args.db, n_clusters=args.clusters, batch_size=args.batch_size, epochs=args.epochs, refit=args.refit)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,197 @@
 # Code from here: https://github.com/jxnl/youtubechapters-backend
 
+from chilean_humor.clients import openai_client
 from chilean_humor.segment import Segment
-from typing import List
-from youtube_transcript_api import YouTubeTranscriptApi
+from chilean_humor.instrument import instrumented, metrics
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from tempfile import TemporaryDirectory
+from typing import List, Optional, Tuple
 from loguru import logger
-from openai import OpenAI
-from chilean_humor.download import download_youtube_video
+import contextvars
+import os
+import re
+import shutil
+import subprocess
 
-from dotenv import load_dotenv
-load_dotenv()
+# Whisper takes at most 25 MB per upload, 10 minutes of re-encoded mono audio stays far below it
+CHUNK_SECONDS = 600
+CHUNK_OVERLAP = 2.0
 
-client = OpenAI()
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+DURATION = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
 
+
+@dataclass
+class AudioChunk:
+    # audio sent to whisper, starting a little before the part of the timeline this chunk owns
+    start: float
+    end: float
+    owned_start: float
+    owned_end: float
+
+
+def parse_silencedetect(output: str) -> Tuple[Optional[float], List[Tuple[float, float]]]:
+    duration = None
+    match = DURATION.search(output)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    starts = [max(float(x), 0.0) for x in SILENCE_START.findall(output)]
+    ends = [float(x) for x in SILENCE_END.findall(output)]
+    # a silence still running at the end of the file has no silence_end
+    if duration is not None and len(ends) < len(starts):
+        ends.append(duration)
+    return duration, list(zip(starts, ends))
+
+
+def detect_silences(path: str, noise_db: int = -30, min_silence: float = 0.5) -> Tuple[Optional[float], List[Tuple[float, float]]]:
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}", "-f", "null", "-"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        # keep the duration if ffmpeg got to print it, plan_chunks then cuts at fixed lengths. Without it the file goes whole
+        logger.info(f"Silence detection failed for {path}, cutting without silences: {(e.stderr or '').strip()[-200:]}")
+        duration, _ = parse_silencedetect(e.stderr or "")
+        return duration, []
+    return parse_silencedetect(result.stderr)
+
+
+def plan_chunks(
+    duration: float,
+    silences: List[Tuple[float, float]],
+    chunk_seconds: float = CHUNK_SECONDS,
+    overlap: float = CHUNK_OVERLAP,
+    search_window: float = 60,
+) -> List[AudioChunk]:
+    # cut in the middle of the silence closest to every chunk_seconds, or right there when none is near
+    midpoints = [(start + end) / 2 for start, end in silences]
+    cuts = [0.0]
+    while duration - cuts[-1] > chunk_seconds:
+        target = cuts[-1] + chunk_seconds
+        near = [m for m in midpoints if cuts[-1] + chunk_seconds / 2 < m <= target and target - m <= search_window]
+        cuts.append(max(near) if near else target)
+    cuts.append(duration)
+    return [
+        AudioChunk(start=max(owned_start - overlap, 0.0), end=min(owned_end + overlap, duration), owned_start=owned_start, owned_end=owned_end)
+        for owned_start, owned_end in zip(cuts, cuts[1:])
+    ]
+
+
+def cut_chunk(path: str, chunk: AudioChunk, output_path: str):
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-ss", f"{chunk.start:.3f}", "-t", f"{chunk.end - chunk.start:.3f}",
+         "-i", path, "-vn", "-ac", "1", "-ar", "16000", "-b:a", "64k", output_path],
+        check=True,
+    )
+
+
+@instrumented("whisper")
+def transcribe_file(path: str, whisper_client, offset: float = 0.0) -> List[Segment]:
+    with open(path, "rb") as audio_file:
+        transcript = whisper_client.audio.transcriptions.create(
+            file=audio_file,
+            model="whisper-1",
+            response_format="verbose_json",
+            timestamp_granularities=["segment"]
+            )
+    # whisper bills the length of the upload, verbose_json reports it as duration
+    duration = getattr(transcript, "duration", None) or (transcript.segments[-1]["end"] if transcript.segments else 0)
+    metrics.audio("whisper", float(duration))
+
+    return [
+        Segment(
+            language=transcript.language,
+            start_time=t["start"] + offset,
+            end_time=t["end"] + offset,
+            transcript=t["text"],
+            from_whisper=True
+        )
+        for t in transcript.segments
+    ]
+
+
+def stitch(chunks: List[AudioChunk], results: List[List[Segment]]) -> List[Segment]:
+    # overlapping audio is transcribed twice, each segment is kept only by the chunk owning its midpoint
+    phrases = []
+    for i, (chunk, segments) in enumerate(zip(chunks, results)):
+        last = i == len(chunks) - 1
+        for segment in segments:
+            midpoint = (segment.start_time + segment.end_time) / 2
+            if chunk.owned_start <= midpoint and (midpoint < chunk.owned_end or last):
+                phrases.append(segment)
+    return phrases
+
+
+def transcribe_audio(
+    path: str,
+    whisper_client=None,
+    chunk_seconds: Optional[float] = CHUNK_SECONDS,
+    overlap: float = CHUNK_OVERLAP,
+    workers: int = 4,
+) -> List[Segment]:
+    # whisper_client is the OpenAI client or a local fake with the same audio.transcriptions.create
+    whisper_client = whisper_client or openai_client()
+    if chunk_seconds is None or shutil.which("ffmpeg") is None:
+        if chunk_seconds is not None:
+            logger.info("ffmpeg not found, sending the whole file to whisper")
+        return transcribe_file(path, whisper_client)
+
+    duration, silences = detect_silences(path)
+    if duration is None or duration <= chunk_seconds:
+        return transcribe_file(path, whisper_client)
+
+    chunks = plan_chunks(duration, silences, chunk_seconds, overlap)
+    logger.info(f"Transcribing {len(chunks)} chunks of {path} with whisper")
+    with TemporaryDirectory(dir=os.path.dirname(path) or None) as tmpdir:
+        paths = [os.path.join(tmpdir, f"chunk_{i}.mp3") for i in range(len(chunks))]
+        for chunk, chunk_path in zip(chunks, paths):
+            cut_chunk(path, chunk, chunk_path)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # each chunk runs in a copy of this context, so whisper usage is attributed to the current routine
+            futures = [
+                executor.submit(contextvars.copy_context().run, transcribe_file, chunk_path, whisper_client, chunk.start)
+                for chunk_path, chunk in zip(paths, chunks)
+            ]
+            results = [future.result() for future in futures]
+    return stitch(chunks, results)
+
+
+def no_transcript_errors() -> Tuple[type, ...]:
+    # the video has no captions at all, only whisper can help. NoTranscriptAvailable is gone in newer releases
+    import youtube_transcript_api
+    names = ("TranscriptsDisabled", "NoTranscriptFound", "NoTranscriptAvailable")
+    return tuple(getattr(youtube_transcript_api, name) for name in names if hasattr(youtube_transcript_api, name))
+
+
+@instrumented("transcribe_youtube")
 def transcribe_youtube(
-    video_id: str
+    video_id: str,
+    transcript_api=None,
+    whisper_client=None,
+    chunk_seconds: Optional[float] = CHUNK_SECONDS,
+    fallback_errors: Optional[Tuple[type, ...]] = None,
 ) -> List[Segment]:
-    
+    # transcript_api is YouTubeTranscriptApi or anything with the same list_transcripts/get_transcript
+    # network errors and 429s are not in fallback_errors, they reach fetch_transcript's retry instead of a paid whisper run
+    if transcript_api is None:
+        from youtube_transcript_api import YouTubeTranscriptApi
+        transcript_api = YouTubeTranscriptApi
+        fallback_errors = fallback_errors or no_transcript_errors()
+    elif fallback_errors is None:
+        # a stand-in declares its own "no captions" errors, youtube_transcript_api is not imported for it
+        fallback_errors = getattr(transcript_api, "fallback_errors", ())
+
     phrases = []
 
     # this function will try to get the transcript from youtube
     try:
-        transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
+        transcript_list = transcript_api.list_transcripts(video_id)
 
         # Get either 'es' or the first generated transcript
         language_code = None
@@ -31,7 +202,7 @@ def transcribe_youtube(
 
         logger.info(f"Transcript {video_id} language code: {language_code}")
 
-        transcript = YouTubeTranscriptApi.get_transcript(
+        transcript = transcript_api.get_transcript(
             video_id, ("es", language_code)
         )
         logger.info("Transcript found on youtube no need to download video")
@@ -44,33 +215,15 @@ def transcribe_youtube(
                     transcript=t["text"],
                 )
             )
-    except Exception as e:
+    except fallback_errors as e:
         logger.info(
             f"Video has transcripts disabled or not found {video_id} {e}"
         )
         logger.info("Downloading video to extract audio")
-        file_name = download_youtube_video(f"https://www.youtube.com/watch?v={video_id}")
-
-        audio_file = open(file_name, "rb")
+        from chilean_humor.download import downloaded_audio
 
-        logger.info(f"Transcript {video_id} using whisper")
+        with downloaded_audio(f"https://www.youtube.com/watch?v={video_id}") as file_name:
+            logger.info(f"Transcript {video_id} using whisper")
+            phrases = transcribe_audio(file_name, whisper_client, chunk_seconds=chunk_seconds)
 
-        transcript = client.audio.transcriptions.create(
-            file=audio_file,
-            model="whisper-1",
-            response_format="verbose_json",
-            timestamp_granularities=["segment"]
-            )
-
-        for t in transcript.segments:
-            phrases.append(
-                Segment(
-                    language=transcript.language,
-                    start_time=t["start"],
-                    end_time=t["end"],
-                    transcript=t["text"],
-                    from_whisper=True
-                )
-            )
-    
     return phrases
@@ -1,6 +1,12 @@
+import hashlib
+import json
+import random
 import re
+import time
 import subprocess
 import os
+import tempfile
+from contextlib import contextmanager
 
 def extract_video_id(url: str) -> str:
     match = re.search(
@@ -19,6 +25,20 @@ def extract_number(s):
     else:
         return None
 
+def timestamp_seconds(timestamp) -> int:
+    # "HH:MM:SS" as written in the jsonl files, or the datetime.time a Joke parses it into
+    if isinstance(timestamp, str):
+        h, m, s = map(int, timestamp.split(":"))
+    else:
+        h, m, s = timestamp.hour, timestamp.minute, timestamp.second
+    return h * 3600 + m * 60 + s
+
+def read_jokes(path: str):
+    # joke imports the LLM clients, which import utils
+    from chilean_humor.joke import Joke
+    with open(path, "r", encoding="utf-8") as file:
+        return [Joke(**json.loads(line)) for line in file]
+
 def execute_bash(command):
     results = subprocess.run(
         command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
@@ -40,4 +60,39 @@ def extract_routines_ids(folder='jokes'):
             # Extract the routine_id and append to the list
             routine_ids.append(int(match.group(1)))
     
-    return routine_ids
\ No newline at end of file
+    return routine_ids
+
+def retry(func, retries=3, base_delay=1.0, max_delay=30.0, sleep=time.sleep, on_retry=None):
+    # exponential backoff with full jitter, the last error is raised once retries run out
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if on_retry:
+                on_retry(attempt + 1, e, delay)
+            sleep(delay)
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def estimate_tokens(text: str) -> int:
+    # conservative for spanish text, avoids pulling a tokenizer just to size requests
+    return len(text) // 3 + 1
+
+@contextmanager
+def atomic_write(path, mode="w", encoding="utf-8"):
+    # write to a temp file next to path and rename it, readers never see a half-written file
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, encoding=None if "b" in mode else encoding) as file:
+            yield file
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
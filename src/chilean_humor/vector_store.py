@@ -0,0 +1,131 @@
+import json
+import os
+from typing import Iterable, List, Optional
+
+import numpy as np
+from loguru import logger
+
+METADATA_FIELDS = ("joke_id", "routine_id", "show_id", "start_time", "url", "text")
+
+EMBEDDINGS_FILE = "embeddings.npy"
+QUANTIZED_FILE = "embeddings.int8.npy"
+SCALES_FILE = "scales.npy"
+METADATA_FILE = "metadata.jsonl"
+
+# rows scored at once, keeps temporary buffers small on large stores
+BLOCK_SIZE = 65536
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _quantize(matrix: np.ndarray):
+    scales = np.abs(matrix).max(axis=-1) / 127.0
+    scales = np.maximum(scales, 1e-12).astype(np.float32)
+    quantized = np.rint(matrix / scales[..., None]).astype(np.int8)
+    return quantized, scales
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class VectorStore:
+    def __init__(self, path: str, embeddings: np.ndarray, metadata: List[dict], quantized: Optional[np.ndarray] = None, scales: Optional[np.ndarray] = None):
+        self.path = path
+        self.embeddings = embeddings
+        self.metadata = metadata
+        self.quantized = quantized
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.metadata)
+
+    @classmethod
+    def build(cls, embedded_chunks: Iterable[dict], path: str, dtype: str = "float32", quantize: bool = True) -> "VectorStore":
+        embedded_chunks = list(embedded_chunks)
+        if not embedded_chunks:
+            raise ValueError(f"No embedded jokes to build the vector store at {path}")
+        os.makedirs(path, exist_ok=True)
+        dimensions = len(embedded_chunks[0]["embedding"])
+
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(path, EMBEDDINGS_FILE), mode="w+", dtype=dtype, shape=(len(embedded_chunks), dimensions)
+        )
+        for start in range(0, len(embedded_chunks), BLOCK_SIZE):
+            block = embedded_chunks[start:start + BLOCK_SIZE]
+            embeddings[start:start + len(block)] = _normalize(np.asarray([c["embedding"] for c in block], dtype=np.float32))
+        embeddings.flush()
+
+        if quantize:
+            quantized, scales = _quantize(np.asarray(embeddings, dtype=np.float32))
+            np.save(os.path.join(path, QUANTIZED_FILE), quantized)
+            np.save(os.path.join(path, SCALES_FILE), scales)
+        else:
+            for name in (QUANTIZED_FILE, SCALES_FILE):
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+
+        with open(os.path.join(path, METADATA_FILE), "w", encoding="utf-8") as file:
+            for chunk in embedded_chunks:
+                file.write(json.dumps({field: chunk.get(field) for field in METADATA_FIELDS}, ensure_ascii=False) + "\n")
+
+        logger.info(f"Stored {len(embedded_chunks)} embeddings in {path}")
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str) -> "VectorStore":
+        # memory-mapped read only, so several processes share the same pages
+        embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+        quantized, scales = None, None
+        if os.path.exists(os.path.join(path, QUANTIZED_FILE)):
+            quantized = np.load(os.path.join(path, QUANTIZED_FILE), mmap_mode="r")
+            scales = np.load(os.path.join(path, SCALES_FILE), mmap_mode="r")
+        with open(os.path.join(path, METADATA_FILE), "r", encoding="utf-8") as file:
+            metadata = [json.loads(line) for line in file]
+        return cls(path, embeddings, metadata, quantized, scales)
+
+    def search(self, query_embedding, k: int = 10, rescore: Optional[int] = None) -> List[dict]:
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        k = min(k, len(self))
+        if k == 0:
+            return []
+
+        if rescore and self.quantized is not None:
+            # coarse int8 pass over the whole matrix, exact scores only for the shortlist
+            candidates = self._scan(self._int8_scores, query, k * rescore)
+            exact = np.asarray(self.embeddings[np.sort(candidates)], dtype=np.float32) @ query
+            order = _top_k(exact, k)
+            ids, scores = np.sort(candidates)[order], exact[order]
+        else:
+            ids = self._scan(self._float_scores, query, k)
+            scores = np.asarray(self.embeddings[ids], dtype=np.float32) @ query
+
+        return [{**self.metadata[i], "score": float(score)} for i, score in zip(ids, scores)]
+
+    def search_text(self, text: str, embedder, k: int = 10, rescore: Optional[int] = None) -> List[dict]:
+        return self.search(embedder.embed_texts([text])[0], k=k, rescore=rescore)
+
+    def _float_scores(self, start, end, query):
+        return np.asarray(self.embeddings[start:end], dtype=np.float32) @ query
+
+    def _int8_scores(self, start, end, query):
+        query_q, query_scale = _quantize(query)
+        scores = self.quantized[start:end].astype(np.int32) @ query_q.astype(np.int32)
+        return scores * (self.scales[start:end] * query_scale)
+
+    def _scan(self, score_fn, query, k) -> np.ndarray:
+        best_ids = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, len(self), BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, len(self))
+            scores = np.concatenate([best_scores, score_fn(start, end, query)])
+            ids = np.concatenate([best_ids, np.arange(start, end)])
+            keep = _top_k(scores, k)
+            best_ids, best_scores = ids[keep], scores[keep]
+        return best_ids
@@ -0,0 +1,185 @@
+import os
+import re
+import sqlite3
+import string
+import tempfile
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(CURRENT_DIR, "jokes.db")
+CSV_PATH = os.path.join(CURRENT_DIR, "jokes_df.csv")
+HUMOR_DB_PATH = os.path.join(CURRENT_DIR, "..", "humor.db")
+
+# columnas que se pueden filtrar, en el orden en que se encadenan los filtros
+FILTER_COLUMNS = ["decada", "edicion", "show_name", "tema"]
+
+Filters = Dict[str, Tuple[str, ...]]
+
+# minúsculas, sin puntuación ni signos de apertura, igual que clean_text antes de filtrar stopwords
+PUNCTUATION = str.maketrans("", "", string.punctuation + "¿¡")
+
+
+def tokenize(text):
+    return text.lower().translate(PUNCTUATION).split()
+
+
+def extract_year(text):
+    match = re.search(r"\b(19|20)\d{2}\b", text)
+    return int(match.group(0)) if match else None
+
+
+def read_humor_db(path: str) -> pd.DataFrame:
+    # mismas columnas que jokes_df.csv, ordenadas por rutina y posición dentro de la rutina
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as conn:
+        # los temas existen solo después de la etapa topics del pipeline
+        has_topics = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'joke_topics'").fetchone() is not None
+        if has_topics:
+            tema = "printf('%02d: %s', topics.ID, topics.KEYWORDS)"
+            joins = "LEFT JOIN joke_topics ON joke_topics.JOKEID = jokes.ID LEFT JOIN topics ON topics.ID = joke_topics.TOPICID "
+        else:
+            tema, joins = "NULL", ""
+        data = pd.read_sql(
+            f"SELECT shows.TITLE AS show_name, jokes.EVENTNAME AS event_name, jokes.TEXT AS text, {tema} AS tema "
+            f"FROM jokes JOIN shows ON shows.ID = jokes.SHOWID {joins}ORDER BY jokes.ID",
+            conn,
+        )
+    # sin año la rutina queda sin edición ni década (NULL), como los chistes sin tema
+    years = data["event_name"].map(extract_year, na_action="ignore").astype("Int64")
+    known = years.notna()
+    data["edicion"] = ("Viña " + years.astype(str)).where(known, None)
+    data["decada"] = ((years // 10) * 10).astype(str).str[-2:].where(known, None)
+    return data[["show_name", "edicion", "decada", "tema", "text"]]
+
+
+def build_db(output_path: str = DB_PATH, humor_db_path: str = HUMOR_DB_PATH, csv_path: str = CSV_PATH) -> str:
+    # humor.db es la fuente cuando existe, si no se usa el CSV que viene con la app
+    if os.path.exists(humor_db_path):
+        data = read_humor_db(humor_db_path)
+    else:
+        data = pd.read_csv(csv_path, dtype={"decada": str})
+        if "tema" not in data:
+            data["tema"] = None
+    # sin tema queda NULL, no NaN
+    data["tema"] = data["tema"].astype(object).where(data["tema"].notnull(), None)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or ".", suffix=".db")
+    os.close(fd)
+    try:
+        with sqlite3.connect(tmp_path) as conn:
+            conn.execute("CREATE TABLE jokes (id INTEGER PRIMARY KEY, decada TEXT, edicion TEXT, show_name TEXT, tema TEXT, text TEXT)")
+            conn.executemany(
+                "INSERT INTO jokes (decada, edicion, show_name, tema, text) VALUES (?, ?, ?, ?, ?)",
+                data[["decada", "edicion", "show_name", "tema", "text"]].itertuples(index=False, name=None),
+            )
+            # un índice por cada prefijo de la cadena de filtros, y uno por columna para filtros sueltos
+            conn.execute("CREATE INDEX jokes_decada_edicion_show ON jokes (decada, edicion, show_name)")
+            conn.execute("CREATE INDEX jokes_edicion_show ON jokes (edicion, show_name)")
+            conn.execute("CREATE INDEX jokes_show ON jokes (show_name)")
+            conn.execute("CREATE INDEX jokes_tema ON jokes (tema)")
+            build_term_counts(conn, data)
+            conn.execute("ANALYZE")
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return output_path
+
+
+def is_stale(path: str = DB_PATH, humor_db_path: str = HUMOR_DB_PATH, csv_path: str = CSV_PATH) -> bool:
+    if not os.path.exists(path):
+        return True
+    source = humor_db_path if os.path.exists(humor_db_path) else csv_path
+    return os.path.getmtime(source) > os.path.getmtime(path)
+
+
+def build_term_counts(conn: sqlite3.Connection, data: pd.DataFrame):
+    # cubo de frecuencias: cada chiste se tokeniza una sola vez y se suma en su celda (década, edición, humorista, tema).
+    # stopwords y largo mínimo se aplican al consultar, sobre los totales
+    conn.execute("CREATE TABLE cells (id INTEGER PRIMARY KEY, decada TEXT, edicion TEXT, show_name TEXT, tema TEXT)")
+    conn.execute("CREATE TABLE terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE, length INTEGER)")
+    conn.execute("CREATE TABLE term_counts (cell_id INTEGER, term_id INTEGER, count INTEGER, PRIMARY KEY (cell_id, term_id)) WITHOUT ROWID")
+
+    terms: Dict[str, int] = {}
+    rows = []
+    for cell_id, (key, group) in enumerate(data.groupby(FILTER_COLUMNS, dropna=False, sort=True), start=1):
+        key = tuple(None if pd.isna(value) else value for value in key)
+        conn.execute("INSERT INTO cells (id, decada, edicion, show_name, tema) VALUES (?, ?, ?, ?, ?)", (cell_id, *key))
+        counts = Counter(word for text in group["text"].dropna() for word in tokenize(text))
+        for term, count in counts.items():
+            term_id = terms.setdefault(term, len(terms) + 1)
+            rows.append((cell_id, term_id, count))
+    conn.executemany("INSERT INTO terms (id, term, length) VALUES (?, ?, ?)", [(i, t, len(t)) for t, i in terms.items()])
+    conn.executemany("INSERT INTO term_counts (cell_id, term_id, count) VALUES (?, ?, ?)", rows)
+    conn.execute("CREATE INDEX cells_filters ON cells (decada, edicion, show_name, tema)")
+
+
+class WordCube:
+    # term_counts en memoria como matriz dispersa (celda, término): un filtro es sumar las filas de sus celdas
+    def __init__(self, conn: sqlite3.Connection):
+        self.cells = pd.read_sql("SELECT id, decada, edicion, show_name, tema FROM cells ORDER BY id", conn)
+        terms = pd.read_sql("SELECT id, term, length FROM terms ORDER BY id", conn)
+        self.terms = np.array([""] + terms["term"].tolist(), dtype=object)
+        self.lengths = np.concatenate([[0], terms["length"].to_numpy()])
+        counts = pd.read_sql("SELECT cell_id, term_id, count FROM term_counts ORDER BY cell_id", conn).to_numpy(dtype=np.int64)
+        self.cell_ids, self.term_ids, self.counts = counts[:, 0], counts[:, 1], counts[:, 2]
+        # filas de cada celda, term_counts viene ordenado por celda
+        self.indptr = np.searchsorted(self.cell_ids, np.arange(len(self.cells) + 2))
+
+    def word_counts(self, filters: Filters, min_word_length: int = 1, stopwords: Iterable[str] = ()) -> pd.DataFrame:
+        selected = np.ones(len(self.cells), dtype=bool)
+        for column in FILTER_COLUMNS:
+            if filters.get(column):
+                selected &= self.cells[column].isin(filters[column]).to_numpy()
+        rows = np.concatenate([np.arange(self.indptr[i], self.indptr[i + 1]) for i in self.cells["id"].to_numpy()[selected]] or [np.array([], dtype=np.int64)])
+        totals = np.bincount(self.term_ids[rows], weights=self.counts[rows], minlength=len(self.terms)).astype(np.int64)
+
+        mask = (totals > 0) & (self.lengths >= min_word_length)
+        stopwords = set(stopwords)
+        if stopwords:
+            mask &= ~np.isin(self.terms, list(stopwords))
+        counts = pd.DataFrame({"Palabra": self.terms[mask], "Frecuencia": totals[mask]})
+        return counts.sort_values(["Frecuencia", "Palabra"], ascending=[False, True], ignore_index=True)
+
+
+def connect(path: str = DB_PATH) -> sqlite3.Connection:
+    if is_stale(path):
+        build_db(path)
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+
+def where_clause(filters: Filters) -> Tuple[str, List[str]]:
+    conditions, params = [], []
+    for column in FILTER_COLUMNS:
+        values = filters.get(column)
+        if values:
+            conditions.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+def distinct_values(conn: sqlite3.Connection, column: str, filters: Filters) -> List[str]:
+    where, params = where_clause(filters)
+    rows = conn.execute(f"SELECT DISTINCT {column} FROM jokes{where} ORDER BY {column}", params)
+    return [value for (value,) in rows if value is not None]
+
+
+def count_jokes(conn: sqlite3.Connection, filters: Filters) -> int:
+    where, params = where_clause(filters)
+    return conn.execute(f"SELECT COUNT(*) FROM jokes{where}", params).fetchone()[0]
+
+
+def page_jokes(conn: sqlite3.Connection, filters: Filters, page_size: int = 50, page: int = 1) -> pd.DataFrame:
+    where, params = where_clause(filters)
+    return pd.read_sql(
+        f"SELECT show_name, edicion, decada, tema, text FROM jokes{where} ORDER BY id LIMIT ? OFFSET ?",
+        conn,
+        params=[*params, page_size, (page - 1) * page_size],
+    )
+
+
+if __name__ == "__main__":
+    print(f"Built {build_db()}")
@@ -1,8 +1,3 @@
-import os
-import re
-import string
-from collections import Counter
-
 import altair as alt
 import matplotlib.pyplot as plt
 import nltk
@@ -12,6 +7,8 @@ from wordcloud import WordCloud
 
 import streamlit as st
 
+import db
+
 # Verifica si los stopwords están descargados; si no, los descarga.
 try:
     stopwords.words("spanish")
@@ -19,37 +16,28 @@ except LookupError:
     nltk.download("stopwords")
 
 
-# Función para limpiar y procesar el texto con stopwords adicionales y longitud mínima de palabra
-def clean_text(text, extra_stopwords, min_word_length):
-    text = text.lower()  # Convertir a minúsculas
-
-    # Usar expresiones regulares para eliminar los signos de apertura y cierre de interrogación y exclamación
-    text = re.sub(r"[¿¡]", "", text)
+# Stopwords en español, se cargan una sola vez por proceso
+@st.cache_resource
+def spanish_stopwords():
+    return frozenset(stopwords.words("spanish"))
 
-    text = "".join(
-        [char for char in text if char not in string.punctuation]
-    )  # Quitar puntuación
-    tokens = text.split()  # Tokenizar
 
-    # Cargar stopwords en español y añadir las personalizadas
-    stop_words = set(stopwords.words("spanish"))
-    if extra_stopwords:
-        stop_words.update(extra_stopwords)
+# Función para limpiar y procesar el texto con stopwords adicionales y longitud mínima de palabra
+def clean_text(text, extra_stopwords, min_word_length):
+    stop_words = spanish_stopwords().union(extra_stopwords or ())
 
     # Filtrar stopwords y palabras más cortas que min_word_length
-    tokens = [
+    return [
         word
-        for word in tokens
+        for word in db.tokenize(text)
         if word not in stop_words and len(word) >= min_word_length
     ]
 
-    return tokens
-
 
 # Función para generar wordcloud
-def generate_wordcloud(text):
-    wordcloud = WordCloud(width=800, height=400, background_color="white").generate(
-        " ".join(text)
+def generate_wordcloud(frequencies):
+    wordcloud = WordCloud(width=800, height=400, background_color="white").generate_from_frequencies(
+        frequencies
     )
     plt.figure(figsize=(10, 5))
     plt.imshow(wordcloud, interpolation="bilinear")
@@ -57,20 +45,49 @@ def generate_wordcloud(text):
     st.pyplot(plt)
 
 
-# Cargar el dataset
+# Conexión de solo lectura a streamlit/jokes.db, se construye desde humor.db si no existe
+@st.cache_resource
+def get_connection():
+    return db.connect()
+
+
+# Los resultados se guardan por combinación de filtros (tuplas ordenadas, para que sean hashables)
 @st.cache_data
-def load_data():
-    # Obtener la ruta absoluta del archivo CSV
-    current_dir = os.path.dirname(
-        os.path.abspath(__file__)
-    )  # Directorio actual del script
-    file_path = os.path.join(
-        current_dir, "jokes_df.csv"
-    )  # Ruta completa al archivo CSV
+def load_options(column, filters):
+    return db.distinct_values(get_connection(), column, dict(filters))
 
-    # Cargar los datos
-    data = pd.read_csv(file_path, dtype={"decada": str})
-    return data
+
+@st.cache_data
+def load_count(filters):
+    return db.count_jokes(get_connection(), dict(filters))
+
+
+@st.cache_data
+def load_page(filters, page_size, page):
+    return db.page_jokes(get_connection(), dict(filters), page_size, page)
+
+
+@st.cache_resource
+def get_word_cube():
+    return db.WordCube(get_connection())
+
+
+# Suma de las celdas precalculadas que calzan con los filtros
+@st.cache_data
+def load_word_counts(filters, extra_stopwords, min_word_length):
+    return get_word_cube().word_counts(dict(filters), min_word_length, spanish_stopwords().union(extra_stopwords))
+
+
+def select_filter(label, column, filters):
+    options = load_options(column, filters)
+    selected = st.multiselect(
+        label,
+        ["Todos"] + options,  # Añadir 'Todos' al inicio de la lista ordenada
+        default="Todos",
+    )
+    if "Todos" in selected or not selected:
+        return filters
+    return filters + ((column, tuple(sorted(selected))),)
 
 
 # Función para reiniciar el estado de los botones
@@ -117,48 +134,12 @@ def main():
     # Inicializar el estado de session_state
     initialize_session_state()
 
-    # Cargar los datos
-    data = load_data()
-
-    # Filtrar por década
-    decades = sorted(data["decada"].unique())
-    selected_decades = st.multiselect(
-        "Selecciona una o más décadas",
-        ["Todos"] + decades,  # Añadir 'Todos' al inicio de la lista ordenada
-        default="Todos",
-    )
-    if "Todos" in selected_decades:
-        filtered_by_decade = data
-    else:
-        filtered_by_decade = data[data["decada"].isin(selected_decades)]
-
-    # Filtrar por festival basado en la selección de década
-    event_names = sorted(filtered_by_decade["edicion"].unique())
-    selected_events = st.multiselect(
-        "Selecciona uno o más festivales",
-        ["Todos"] + event_names,  # Añadir 'Todos' al inicio de la lista ordenada
-        default="Todos",
-    )
-    if "Todos" in selected_events:
-        filtered_by_event = filtered_by_decade
-    else:
-        filtered_by_event = filtered_by_decade[
-            filtered_by_decade["edicion"].isin(selected_events)
-        ]
-
-    # Filtrar por humorista basado en la selección de festival
-    show_names = sorted(filtered_by_event["show_name"].unique())
-    selected_shows = st.multiselect(
-        "Selecciona uno o más humoristas",
-        ["Todos"] + show_names,  # Añadir 'Todos' al inicio de la lista ordenada
-        default="Todos",
-    )
-    if "Todos" in selected_shows:
-        filtered_data = filtered_by_event
-    else:
-        filtered_data = filtered_by_event[
-            filtered_by_event["show_name"].isin(selected_shows)
-        ]
+    # Los filtros se encadenan: cada selección limita las opciones de la siguiente
+    filters = ()
+    filters = select_filter("Selecciona una o más décadas", "decada", filters)
+    filters = select_filter("Selecciona uno o más festivales", "edicion", filters)
+    filters = select_filter("Selecciona uno o más humoristas", "show_name", filters)
+    filters = select_filter("Selecciona uno o más temas", "tema", filters)
 
     # Agregar cuadro de texto para nuevas stopwords
     custom_stopwords = st.text_input(
@@ -185,20 +166,27 @@ def main():
     # Mostrar el dataset filtrado (si ya se activó el botón correspondiente)
     if st.session_state["show_df"]:
         st.subheader("Dataset original sin limpiar")
-        st.write(filtered_data)
+        total = load_count(filters)
+        page_size = st.selectbox("Chistes por página", [25, 50, 100], index=1)
+        pages = max((total + page_size - 1) // page_size, 1)
+        page = st.number_input(f"Página (de {pages})", min_value=1, max_value=pages, value=1)
+        st.caption(f"{total} chistes")
+        st.dataframe(load_page(filters, page_size, page), use_container_width=True)
 
     # Limpiar y procesar el texto de los chistes filtrados
     if st.session_state["show_df"] and not st.session_state["clean_df"]:
         if st.button("Limpiar datos"):
             st.session_state["clean_df"] = True
-            st.session_state["chistes_limpios"] = filtered_data["text"].apply(
-                lambda x: clean_text(x, custom_stopwords, min_word_length)
-            )
 
-    # Mostrar el dataset limpio
+    # Mostrar el dataset limpio (la misma página que el dataset original)
     if st.session_state["clean_df"]:
         st.subheader("Dataset sin stopwords y signos de puntuación")
-        st.write(st.session_state["chistes_limpios"])
+        st.write(
+            load_page(filters, page_size, page)["text"].apply(
+                lambda x: clean_text(x, custom_stopwords, min_word_length)
+            )
+        )
+        word_df = load_word_counts(filters, tuple(sorted(custom_stopwords)), min_word_length)
 
     # Generar y mostrar wordcloud
     if st.session_state["clean_df"] and not st.session_state["show_wordcloud"]:
@@ -207,16 +195,10 @@ def main():
 
     if st.session_state["show_wordcloud"]:
         st.subheader(f"Wordcloud de chistes")
-        if st.session_state["chistes_limpios"] is not None:
-            all_words = [
-                word
-                for chiste in st.session_state["chistes_limpios"]
-                for word in chiste
-            ]
-            if all_words:
-                generate_wordcloud(all_words)
-            else:
-                st.write("No hay chistes disponibles para este filtro.")
+        if len(word_df) > 0:
+            generate_wordcloud(dict(zip(word_df["Palabra"], word_df["Frecuencia"])))
+        else:
+            st.write("No hay chistes disponibles para este filtro.")
 
     # Generar y mostrar el gráfico de las 10 palabras más comunes
     if st.session_state["show_wordcloud"] and not st.session_state["show_top10"]:
@@ -225,33 +207,15 @@ def main():
 
     if st.session_state["show_top10"]:
         st.subheader("Top 10 palabras más frecuentes")
-        if st.session_state["chistes_limpios"] is not None:
-            all_words = [
-                word
-                for chiste in st.session_state["chistes_limpios"]
-                for word in chiste
-            ]
-            word_counts = Counter(all_words)
-            common_words = word_counts.most_common(10)
-            if common_words:
-                # Crear DataFrame y ordenar por frecuencia
-                df_common_words = pd.DataFrame(
-                    common_words, columns=["Palabra", "Frecuencia"]
-                )
-
-                # Generar gráfico usando Altair
-                generate_altair_bar_chart(df_common_words)
-            else:
-                st.write("No hay palabras suficientes para mostrar el conteo.")
+        df_common_words = word_df.head(10)
+        if len(df_common_words) > 0:
+            # Generar gráfico usando Altair
+            generate_altair_bar_chart(df_common_words)
+        else:
+            st.write("No hay palabras suficientes para mostrar el conteo.")
 
     # Generar archivo CSV con todas las palabras y sus frecuencias
     if st.session_state["clean_df"]:
-        all_words = [
-            word for chiste in st.session_state["chistes_limpios"] for word in chiste
-        ]
-        word_counts = Counter(all_words)
-        word_df = pd.DataFrame(word_counts.items(), columns=["Palabra", "Frecuencia"])
-
         # Botón para descargar CSV
         st.download_button(
             label="Descargar lista de palabras con su frecuencia",
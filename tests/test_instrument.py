@@ -0,0 +1,44 @@
+import asyncio
+
+from chilean_humor import extract_jokes, refine_jokes
+from chilean_humor.instrument import metrics
+from chilean_humor.transcribe import transcribe_youtube
+
+
+class Transcript:
+    is_generated = True
+    language_code = "es"
+
+
+class TranscriptApi:
+    @staticmethod
+    def list_transcripts(video_id):
+        return [Transcript()]
+
+    @staticmethod
+    def get_transcript(video_id, languages):
+        return [{"start": 0.0, "duration": 2.5, "text": "Buenas noches Viña"}]
+
+
+def test_transcribe_youtube_is_recorded():
+    metrics.reset()
+    segments = transcribe_youtube("abcdefghijk", transcript_api=TranscriptApi)
+    assert len(segments) == 1
+    assert metrics.latency["transcribe_youtube"].count == 1
+    assert metrics.report()["stages"]["transcribe_youtube"]["calls"] == 1
+
+
+def test_concurrent_routines_are_attributed_to_their_own_routine(monkeypatch):
+    async def fake_routine(routine_id, *args):
+        await asyncio.sleep(0)
+        metrics.count("llm", "prompt_tokens", routine_id)
+
+    monkeypatch.setattr(extract_jokes, "aextract_routine", fake_routine)
+    monkeypatch.setattr(refine_jokes, "arefine_routine", fake_routine)
+    metrics.reset()
+    asyncio.run(extract_jokes.aextract_routines([3, 7]))
+    asyncio.run(refine_jokes.arefine_routines([3, 7]))
+
+    routines = metrics.report()["routines"]
+    assert routines["3"]["llm"]["prompt_tokens"] == 6
+    assert routines["7"]["llm"]["prompt_tokens"] == 14
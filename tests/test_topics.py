@@ -0,0 +1,31 @@
+import numpy as np
+import sqlite_utils
+
+from chilean_humor.topics import write_topics
+from chilean_humor.vector_store import VectorStore
+
+
+def test_identical_jokes_in_a_routine_keep_their_own_topic_rows(tmp_path):
+    db_path = str(tmp_path / "humor.db")
+    url = "https://www.youtube.com/watch?v=abcdefghijk&start=0"
+    sqlite_utils.Database(db_path)["jokes"].insert_all(
+        [
+            {"ID": 950003, "ROUTINEID": 95, "URL": url, "TEXT": "Aplausos"},
+            {"ID": 950008, "ROUTINEID": 95, "URL": url, "TEXT": "Aplausos"},
+            {"ID": 950009, "ROUTINEID": 95, "URL": url, "TEXT": "Otro chiste"},
+        ],
+        pk="ID",
+    )
+    store = VectorStore.build(
+        [
+            {"joke_id": joke_id, "routine_id": 95, "show_id": 1, "start_time": 0, "url": url, "text": text, "embedding": embedding}
+            for joke_id, text, embedding in [(950003, "Aplausos", [1.0, 0.0]), (950008, "Aplausos", [1.0, 0.0]), (950009, "Otro chiste", [0.0, 1.0])]
+        ],
+        str(tmp_path / "vector_store"),
+    )
+
+    rows = write_topics(db_path, store, np.array([0, 0, 1]), np.ones(3), [["aplausos"], ["chiste"]])
+
+    assert rows == 3
+    topics = dict(sqlite_utils.Database(db_path).execute('SELECT "JOKEID", "TOPICID" FROM "joke_topics"').fetchall())
+    assert topics == {950003: 0, 950008: 0, 950009: 1}